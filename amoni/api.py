@@ -4,30 +4,194 @@
 # https://github.com/anvilistas/amoni/graphs/contributors
 #
 # This software is published at https://github.com/anvilistas/amoni
+"""The amoni python API
+
+Heavy dependencies (pygit2, keyring, cookiecutter, yaml and dotenv) are imported
+within the functions which need them so that importing this module, and hence
+starting the command line interface, stays fast.
+"""
+
+import json
 import os
+import shutil
+import stat
 import subprocess
+import time
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, List, Tuple
-
-import keyring
-import pygit2
-from cookiecutter.main import cookiecutter
-from dotenv import load_dotenv
-from yaml import dump, load
-
-try:
-    from yaml import CDumper as Dumper
-    from yaml import CLoader as Loader
-except ImportError:
-    from yaml import Dumper, Loader
+from typing import Callable, Dict, Iterable, List, Tuple, Union
 
 __version__ = "0.0.13"
 
 COOKIECUTTER_URL = os.environ.get(
     "AMONI_COOKIECUTTER_PATH", "https://github.com/anvilistas/amoni-cookiecutter.git"
 )
+# Without a revision, the template is pinned to the commit first fetched
+COOKIECUTTER_REVISION = os.environ.get("AMONI_COOKIECUTTER_REVISION")
+TEMPLATE_TTL = float(os.environ.get("AMONI_TEMPLATE_TTL", str(24 * 60 * 60)))
 ANVIL_CONFIG_FILE = Path("app", "config.yaml")
-TABLE_STUB_FILE = Path("anvil-stubs", "tables", "app_tables.pyi")
+TABLE_STUB_DIR = Path("anvil-stubs", "tables")
+TABLE_STUB_FILE = TABLE_STUB_DIR / "app_tables.pyi"
+COMPOSE_COMMANDS = (("docker", "compose"), ("docker-compose",))
+COMPOSE_FILES = (
+    "compose.yaml",
+    "compose.yml",
+    "docker-compose.yaml",
+    "docker-compose.yml",
+)
+READY_TIMEOUT = float(os.environ.get("AMONI_READY_TIMEOUT", "120"))
+SYNC_WORKERS = int(os.environ.get("AMONI_SYNC_WORKERS", "8"))
+THEME_HASH_FILE = ".theme.css.hash"
+WATCH_DEBOUNCE = float(os.environ.get("AMONI_WATCH_DEBOUNCE", "0.3"))
+WATCHED_EVENTS = ("created", "modified", "moved", "deleted")
+IMAGE_CHECK_TTL = float(os.environ.get("AMONI_IMAGE_CHECK_TTL", str(60 * 60)))
+APP_MIRROR_TTL = float(os.environ.get("AMONI_APP_MIRROR_TTL", str(60 * 60)))
+# Published images whose layers builds of the matching services can reuse
+BUILD_CACHE_IMAGES = {
+    "app": "ghcr.io/anvilistas/amoni/app-server:latest",
+    "test_runner": "ghcr.io/anvilistas/amoni/test_runner:latest",
+}
+# Cache mounts in the Dockerfiles need BuildKit, which older versions of docker and
+# docker-compose only use when asked
+BUILD_ENV = {"DOCKER_BUILDKIT": "1", "COMPOSE_DOCKER_CLI_BUILD": "1"}
+TEST_SERVICE = "test_runner"
+JUNIT_MARKER = "--- amoni junit report ---"
+SHARD_SCRIPT = (
+    'pytest "$@" --junitxml=/tmp/amoni-junit.xml; status=$?; '
+    f'echo "{JUNIT_MARKER}"; cat /tmp/amoni-junit.xml; exit $status'
+)
+DB_SERVICE = "db"
+DB_INDEX_FILE = Path("db", "indexes.yaml")
+DB_CONFIG_TARGET = "/etc/postgresql/postgresql.conf"
+DB_CONFIG_SOURCE = "./db/postgresql.${AMONI_DB_PROFILE:-tuned}.conf"
+DB_CONFIG_VOLUME = f"{DB_CONFIG_SOURCE}:{DB_CONFIG_TARGET}:ro"
+APP_SERVICE = "app"
+# Memory used by the JVM beyond its heap, such as metaspace and thread stacks
+JVM_OVERHEAD_MB = 256
+SERVER_PRESETS = {
+    "dev": {
+        "heap_mb": 512,
+        "workers": 4,
+        "worker_memory_mb": 256,
+        "worker_timeout": 30,
+        "app_cache_size": 16,
+    },
+    "load-test": {
+        "heap_mb": 2048,
+        "workers": 16,
+        "worker_memory_mb": 256,
+        "worker_timeout": 60,
+        "app_cache_size": 64,
+    },
+}
+COLUMN_TYPES = {
+    "string": "str",
+    "number": "float",
+    "bool": "bool",
+    "date": "_date",
+    "datetime": "_datetime",
+    "simpleObject": "_Any",
+    "media": "_Media",
+}
+# The stubs import names under private aliases so that tables called, for
+# example, date or Row cannot shadow them
+STUB_HEADER = """from datetime import date as _date
+from datetime import datetime as _datetime
+from typing import Any as _Any
+from typing import Iterable as _Iterable
+from typing import List as _List
+from typing import Literal as _Literal
+from typing import Optional as _Optional
+from typing import overload as _overload
+
+from anvil import Media as _Media
+from anvil.tables import Row as _Row
+from anvil.tables import Table as _Table"""
+
+_compose_command = None
+
+
+def _cache_dir() -> Path:
+    """The per-user directory where amoni keeps its caches"""
+    if "AMONI_CACHE_DIR" in os.environ:
+        return Path(os.environ["AMONI_CACHE_DIR"])
+    if os.name == "nt" and "LOCALAPPDATA" in os.environ:
+        return Path(os.environ["LOCALAPPDATA"], "amoni", "Cache")
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base, "amoni")
+
+
+def _binary_fingerprint() -> List:
+    """The path and mtime of each binary which could provide docker compose"""
+    fingerprint = []
+    for binary in {command[0] for command in COMPOSE_COMMANDS}:
+        path = shutil.which(binary)
+        mtime = os.stat(path).st_mtime if path else None
+        fingerprint.append([binary, path, mtime])
+    return sorted(fingerprint, key=lambda entry: entry[0])
+
+
+def _detect_compose_command() -> Tuple[str, ...]:
+    for command in COMPOSE_COMMANDS:
+        if shutil.which(command[0]) is None:
+            continue
+        result = subprocess.run(
+            [*command, "version"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        if result.returncode == 0:
+            return command
+    raise RuntimeError("Neither 'docker compose' nor 'docker-compose' is available")
+
+
+def compose_command() -> Tuple[str, ...]:
+    """Get the command which runs docker compose on this machine
+
+    The result is detected once and cached per user, keyed on the location and
+    modification time of the docker binaries, so that it is only detected again
+    when those are installed, upgraded or removed.
+
+    Returns
+    -------
+    Tuple[str, ...]
+        Either ("docker", "compose") or ("docker-compose",)
+
+    Raises
+    ------
+    RuntimeError
+        If neither command is available
+    """
+    global _compose_command
+    if _compose_command is not None:
+        return _compose_command
+
+    fingerprint = _binary_fingerprint()
+    cache_file = _cache_dir() / "compose.json"
+    try:
+        cached = json.loads(cache_file.read_text())
+        if cached["fingerprint"] == fingerprint:
+            _compose_command = tuple(cached["command"])
+            return _compose_command
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    _compose_command = _detect_compose_command()
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        cache_file.write_text(
+            json.dumps({"fingerprint": fingerprint, "command": _compose_command})
+        )
+    except OSError:
+        pass
+    return _compose_command
+
+
+def _compose(*args: str, error: str, **kwargs) -> subprocess.CompletedProcess:
+    """Run a docker compose command, raising a RuntimeError with the given
+    message if it fails"""
+    try:
+        return subprocess.run([*compose_command(), *args], check=True, **kwargs)
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"{error}: {e}")
 
 
 def get_ports() -> Tuple[str, str, str, bool]:
@@ -43,6 +207,8 @@ def get_ports() -> Tuple[str, str, str, bool]:
         A tuple containing (app_port, db_port, origin_url, env_file_found)
         where env_file_found indicates if the .env file was loaded successfully
     """
+    from dotenv import load_dotenv
+
     env_file_found = load_dotenv(dotenv_path=".env")
 
     app_port = os.environ.get("AMONI_APP_PORT", "3030")
@@ -52,36 +218,256 @@ def get_ports() -> Tuple[str, str, str, bool]:
     return app_port, db_port, origin_url, env_file_found
 
 
-def _commit_all(
-    message, repo=None, ref=None, author=None, committer=None, tree=None, parents=None
+def _in_nested_repo(workdir: Path, path: Path) -> bool:
+    parent = path.parent
+    while parent != workdir and workdir in parent.parents:
+        if Path(parent, ".git").exists():
+            return True
+        parent = parent.parent
+    return False
+
+
+def _stage(repo, paths: Iterable) -> None:
+    """Stage the given paths, relative to the repository's working directory
+
+    Paths within submodules and ignored paths are skipped and paths which no
+    longer exist are removed from the index.
+    """
+    workdir = Path(repo.workdir).resolve()
+    for path in paths:
+        path = Path(workdir, path).resolve()
+        relative = path.relative_to(workdir).as_posix()
+        if _in_nested_repo(workdir, path) or repo.path_is_ignored(relative):
+            continue
+        if path.exists():
+            repo.index.add(relative)
+        elif relative in repo.index:
+            repo.index.remove(relative)
+
+
+def _commit(
+    message,
+    paths: Iterable = None,
+    repo=None,
+    ref=None,
+    author=None,
+    committer=None,
+    tree=None,
+    parents=None,
 ):
-    cwd = os.getcwd()
+    """Commit the given paths, or the entire working tree if no paths are given
+
+    Nothing is committed if the staged tree is the same as HEAD's.
+    """
+    import pygit2
+
     repo = repo or pygit2.Repository(".")
-    os.chdir(repo.path)
-    repo.index.add_all()
+    if paths is None:
+        repo.index.add_all()
+    else:
+        _stage(repo, paths)
     repo.index.write()
 
+    tree = tree or repo.index.write_tree()
+    if parents is None:
+        if repo.head.peel(pygit2.Commit).tree_id == tree:
+            return
+        parents = [repo.head.target]
     ref = ref or repo.head.name
     author = author or repo.default_signature
     committer = committer or repo.default_signature
-    tree = tree or repo.index.write_tree()
-    parents = parents if parents is not None else [repo.head.target]
     repo.create_commit(ref, author, committer, message, tree, parents)
 
-    os.chdir(cwd)
+
+def _commit_all(message, **kwargs):
+    _commit(message, paths=None, **kwargs)
+
+
+def _load_yaml(path: Path) -> Dict:
+    import yaml
+
+    with Path(path).open() as f:
+        return yaml.load(f, Loader=getattr(yaml, "CLoader", yaml.Loader))
+
+
+@lru_cache(maxsize=None)
+def _umask() -> int:
+    # The umask can only be read by setting it, so do that once
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def _write_atomic(path: Path, content: str) -> None:
+    import tempfile
+
+    path = Path(path)
+    # Write to a temporary file alongside the target and rename it into place so
+    # that readers never see a partially written file
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        # mkstemp creates the file readable by its owner only, so give it the
+        # target's permissions, or the usual ones for a new file
+        try:
+            mode = stat.S_IMODE(path.stat().st_mode)
+        except FileNotFoundError:
+            mode = 0o666 & ~_umask()
+        os.chmod(temp_path, mode)
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def _dump_yaml(data: Dict, path: Path) -> None:
+    import yaml
+
+    _write_atomic(path, yaml.dump(data, Dumper=getattr(yaml, "CDumper", yaml.Dumper)))
+
+
+def _get_anvil_config() -> Dict:
+    return _load_yaml(ANVIL_CONFIG_FILE)
+
+
+def _get_main_app() -> str:
+    return Path(_get_anvil_config()["app"]).name
 
 
 def _get_app_config(app: str) -> Dict:
-    config_file = Path("app", app, "anvil.yaml")
-    return load(config_file.open(), Loader=Loader)
+    return _load_yaml(Path("app", app, "anvil.yaml"))
 
 
 def _save_app_config(app: str, config: Dict) -> None:
-    config_file = Path("app", app, "anvil.yaml")
-    dump(config, config_file.open("w"), Dumper=Dumper)
+    _dump_yaml(config, Path("app", app, "anvil.yaml"))
+
+
+def _git(*args: str, error: str, **kwargs) -> subprocess.CompletedProcess:
+    try:
+        return subprocess.run(
+            ["git", *args], check=True, capture_output=True, text=True, **kwargs
+        )
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"{error}: {e.stderr}")
+
+
+def template_path(
+    refresh: bool = False, offline: bool = False, revision: str = COOKIECUTTER_REVISION
+) -> Path:
+    """Get a local copy of the project template
+
+    The template repository is cloned once into the user cache directory. Each
+    revision is exported into its own directory, which is never modified once
+    created.
+
+    Without a revision, the template is pinned to the commit of the
+    repository's default branch when it was first fetched, and moves to a newer
+    commit only when a refresh is requested. A branch or tag is fetched again
+    when requested or when the last fetch is older than AMONI_TEMPLATE_TTL
+    seconds.
+
+    Parameters
+    ----------
+    refresh
+        Whether to fetch the template repository regardless of its age, moving
+        the pinned commit to the latest one
+    offline
+        Whether to use the cached template without any network access
+    revision
+        The branch, tag or commit of the template to use, rather than the pinned
+        commit
 
+    Returns
+    -------
+    Path
+        The directory containing the template at the requested revision
 
-def init(directory: Path, app: str) -> None:
+    Raises
+    ------
+    RuntimeError
+        If the template cannot be fetched or is not cached when offline
+    """
+    import hashlib
+    import io
+    import tarfile
+    import tempfile
+
+    url = COOKIECUTTER_URL
+    if Path(url).is_dir():
+        return Path(url)
+
+    cache = _cache_dir() / "templates" / hashlib.sha1(url.encode()).hexdigest()
+    mirror = cache / "mirror.git"
+    fetched = cache / "fetched"
+    pin = cache / "pinned"
+    pinned = revision is None
+    if pinned and not refresh and pin.exists():
+        export = cache / pin.read_text().strip()
+        if export.exists():
+            return export
+    if not mirror.exists():
+        if offline:
+            raise RuntimeError(f"{url} is not in the template cache")
+        cache.mkdir(parents=True, exist_ok=True)
+        clone = ["clone", "--mirror", "--quiet", url, str(mirror)]
+        _git(*clone, error=f"Failed to clone template {url}")
+        fetched.touch()
+    elif not offline and (
+        refresh
+        or (pinned and not pin.exists())
+        or (
+            not pinned
+            and (
+                not fetched.exists()
+                or time.time() - fetched.stat().st_mtime > TEMPLATE_TTL
+            )
+        )
+    ):
+        fetch = ["fetch", "--prune", "--quiet", "origin"]
+        _git(*fetch, cwd=mirror, error=f"Failed to fetch template {url}")
+        fetched.touch()
+
+    if pinned and not refresh and pin.exists():
+        commit = pin.read_text().strip()
+    else:
+        rev_parse = ["rev-parse", "--verify", f"{revision or 'HEAD'}^{{commit}}"]
+        error = f"Unknown template revision {revision}"
+        commit = _git(*rev_parse, cwd=mirror, error=error).stdout.strip()
+        if pinned:
+            _write_atomic(pin, commit)
+    export = cache / commit
+    if not export.exists():
+        archive = ["git", "archive", "--format=tar", commit]
+        result = subprocess.run(archive, cwd=mirror, capture_output=True)
+        if result.returncode != 0:
+            raise RuntimeError(
+                f"Failed to export template revision {commit}: "
+                f"{result.stderr.decode(errors='replace')}"
+            )
+        staging = Path(tempfile.mkdtemp(dir=cache, prefix=".export-"))
+        try:
+            with tarfile.open(fileobj=io.BytesIO(result.stdout)) as tar:
+                # The data filter refuses absolute paths, links out of the
+                # folder and special files. Pythons without it predate the
+                # filter argument.
+                if hasattr(tarfile, "data_filter"):
+                    tar.extractall(staging, filter="data")
+                else:
+                    tar.extractall(staging)
+            try:
+                os.replace(staging, export)
+            except OSError:
+                # Another process exported the same revision first
+                pass
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+    return export
+
+
+def init(
+    directory: Path, app: str, refresh_template: bool = False, offline: bool = False
+) -> None:
     """Initialise an amoni project
 
     Parameters
@@ -90,9 +476,16 @@ def init(directory: Path, app: str) -> None:
         The full path of the amoni project folder to create
     app
         The name of folder within the 'app' folder which contains the app to be run
+    refresh_template
+        Whether to fetch the latest template rather than use the cached copy
+    offline
+        Whether to render the cached template without any network access
     """
+    import pygit2
+    from cookiecutter.main import cookiecutter
+
     cookiecutter(
-        COOKIECUTTER_URL,
+        str(template_path(refresh=refresh_template, offline=offline)),
         no_input=True,
         output_dir=directory.parent,
         extra_context={"project_name": directory.name, "app_folder_name": app},
@@ -101,81 +494,284 @@ def init(directory: Path, app: str) -> None:
     _commit_all("Initial commit", repo=repo, ref="HEAD", parents=[])
 
 
-def pull_image(name: str) -> None:
-    """Pull a docker image from the github registry
+def _compose_override_file() -> Path:
+    """The override file which docker compose merges into the project's file"""
+    for name in COMPOSE_FILES:
+        path = Path(name)
+        if path.exists():
+            return path.with_name(f"{path.stem}.override{path.suffix}")
+    raise RuntimeError("There is no docker compose file in the current directory")
+
+
+def _postgres_settings(command: List[str]) -> Dict[str, str]:
+    """The settings passed with -c in a postgres command"""
+    settings = {}
+    for flag, option in zip(command[1:], command[2:]):
+        if flag == "-c":
+            key, _, value = option.partition("=")
+            settings[key] = value
+    return settings
+
+
+def pull_image(*names: str) -> None:
+    """Pull docker images from the github registry
 
     Parameters
     ----------
-    name
-        The name of the image to pull
+    names
+        The names of the images to pull
 
     Raises
     ------
     RuntimeError
-        If both docker compose and docker-compose commands fail
+        If the docker compose command fails
     """
-    try:
-        subprocess.run(["docker", "compose", "pull", name], check=True)
-    except subprocess.CalledProcessError:
-        try:
-            subprocess.run(["docker-compose", "pull", name], check=True)
-        except subprocess.CalledProcessError as e:
-            raise RuntimeError(f"Failed to pull image {name}: {e}")
+    _compose("pull", *names, error=f"Failed to pull image {' '.join(names)}")
+
+
+def _project_compose_files() -> List[str]:
+    """The compose files docker compose reads for the project, in order"""
+    from dotenv import dotenv_values
+
+    files = os.environ.get("COMPOSE_FILE")
+    files = files or dotenv_values(".env").get("COMPOSE_FILE")
+    if files:
+        separator = os.environ.get("COMPOSE_PATH_SEPARATOR") or os.pathsep
+        return files.split(separator)
+    override = _compose_override_file()
+    main = next(name for name in COMPOSE_FILES if Path(name).exists())
+    return [main, str(override)] if override.exists() else [main]
+
 
+def _build_cache_args(services: Iterable[str]) -> List[str]:
+    """Options for docker compose letting builds of the services reuse the layers
+    of amoni's published images
 
-def build_image(name: str) -> None:
-    """Build a docker image
+    The images are added in a compose file kept in the project's cache directory,
+    so that builds leave the project's own files alone.
+    """
+    config = _compose_config()["services"]
+    overrides = {}
+    for service in services:
+        image = BUILD_CACHE_IMAGES.get(service)
+        build = config.get(service, {}).get("build")
+        if not image or build is None:
+            continue
+        cache_from = build.get("cache_from", []) if isinstance(build, dict) else []
+        if image not in cache_from:
+            overrides[service] = {"build": {"cache_from": [*cache_from, image]}}
+    if not overrides:
+        return []
+    path = _project_cache_dir() / "build-cache.yml"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    _dump_yaml({"services": overrides}, path)
+    files = [*_project_compose_files(), str(path)]
+    return [option for file in files for option in ("-f", file)]
+
+
+def build_image(*names: str) -> None:
+    """Build docker images
+
+    The builds use BuildKit, so that downloads are kept between builds, and reuse
+    the layers of amoni's published images.
 
     Parameters
     ----------
-    name
-        The name of the image to build
+    names
+        The names of the images to build
 
     Raises
     ------
     RuntimeError
-        If both docker compose and docker-compose commands fail
+        If the docker compose command fails
     """
-    try:
-        subprocess.run(["docker", "compose", "build", "--pull", name], check=True)
-    except subprocess.CalledProcessError:
+    _compose(
+        *_build_cache_args(names),
+        "build",
+        "--pull",
+        *names,
+        error=f"Failed to build image {' '.join(names)}",
+        env={**os.environ, **BUILD_ENV},
+    )
+
+
+def _stream_compose(service: str, args: List[str], output: Callable) -> float:
+    """Run a docker compose command, passing each line of its output to output"""
+    started = time.monotonic()
+    process = subprocess.Popen(
+        [*compose_command(), *args],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
+        env={**os.environ, **BUILD_ENV},
+    )
+    lines = []
+    for line in process.stdout:
+        lines.append(line)
+        if output:
+            output(service, line.rstrip())
+    if process.wait() != 0:
+        # Keep the end of the output for the error message
+        raise RuntimeError(f"{' '.join(args)} failed: {''.join(lines[-5:])}")
+    return time.monotonic() - started
+
+
+def refresh_images(
+    build: Iterable[str] = (), pull: Iterable[str] = (), output: Callable = None
+) -> Dict[str, float]:
+    """Build and pull the images of several services at the same time
+
+    Parameters
+    ----------
+    build
+        The services whose images to build, pulling newer base images first
+    pull
+        The services whose images to pull
+    output
+        Called with the name of the service and each line of output from its
+        build or pull as it arrives
+
+    Returns
+    -------
+    Dict[str, float]
+        The seconds taken for each service
+
+    Raises
+    ------
+    RuntimeError
+        If any of the builds or pulls fail, after all of them have finished
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    build = list(build)
+    cache = _build_cache_args(build) if build else []
+    jobs = {service: [*cache, "build", "--pull", service] for service in build}
+    jobs.update({service: ["pull", service] for service in pull})
+    with ThreadPoolExecutor(max_workers=len(jobs) or 1) as executor:
+        futures = {
+            service: executor.submit(_stream_compose, service, args, output)
+            for service, args in jobs.items()
+        }
+    timings, errors = {}, []
+    for service, future in futures.items():
+        try:
+            timings[service] = future.result()
+        except RuntimeError as e:
+            errors.append(f"{service}: {e}")
+    if errors:
+        raise RuntimeError("Failed to update images\n" + "\n".join(errors))
+    _write_image_check([])
+    return timings
+
+
+def _image_check_file() -> Path:
+    return _project_cache_dir() / "images.json"
+
+
+def _write_image_check(newer: List[str]) -> None:
+    path = _image_check_file()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    _write_atomic(path, json.dumps({"checked": time.time(), "newer": newer}))
+
+
+def check_for_newer_images() -> List[str]:
+    """Find the services whose images have a newer version in their registry
+
+    Only services using a pulled image are checked. The result is recorded for
+    :func:`newer_images`.
+
+    Returns
+    -------
+    List[str]
+        The services with newer images
+
+    Raises
+    ------
+    RuntimeError
+        If the docker daemon cannot be reached
+    """
+    engine = _engine()
+    if engine is None:
+        raise RuntimeError("Cannot reach the docker daemon")
+    newer = []
+    for service, config in _compose_config()["services"].items():
+        if "image" not in config or "build" in config:
+            continue
+        local = engine.image(config["image"])
+        if local is None:
+            continue
         try:
-            subprocess.run(["docker-compose", "build", "--pull", name], check=True)
-        except subprocess.CalledProcessError as e:
-            raise RuntimeError(f"Failed to build image {name}: {e}")
+            remote = engine.distribution(config["image"])["Descriptor"]["digest"]
+        except RuntimeError:
+            # The registry cannot be reached or the image is only local
+            continue
+        digests = {d.rpartition("@")[2] for d in local.get("RepoDigests", [])}
+        if remote not in digests:
+            newer.append(service)
+    _write_image_check(newer)
+    return newer
+
+
+def newer_images() -> List[str]:
+    """The services found to have newer images by the last check"""
+    try:
+        return json.loads(_image_check_file().read_text())["newer"]
+    except (OSError, ValueError, KeyError):
+        return []
+
+
+def check_for_newer_images_in_background() -> bool:
+    """Start checking for newer images in a separate process
+
+    The check runs at most once every AMONI_IMAGE_CHECK_TTL seconds and its result
+    is available from :func:`newer_images` once it has finished, so the current
+    command is not held up.
+
+    Returns
+    -------
+    bool
+        Whether a check was started
+    """
+    import sys
+
+    try:
+        checked = json.loads(_image_check_file().read_text())["checked"]
+    except (OSError, ValueError, KeyError):
+        checked = 0
+    if time.time() - checked < IMAGE_CHECK_TTL:
+        return False
+    # Record the time now so that a check which fails is not retried at once
+    _write_image_check(newer_images())
+    code = "from amoni import api; api.check_for_newer_images()"
+    subprocess.Popen(
+        [sys.executable, "-c", code],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    return True
 
 
-def start_service(name: str, detach: bool) -> None:
-    """Start a given service
+def start_service(names: Union[str, Iterable[str]], detach: bool = False) -> None:
+    """Start the given services
 
     Parameters
     ----------
-    name
-        The name of the service to start
+    names
+        The name of the service to start, or of each of several services
     detach
         Whether to detach from the service console
 
     Raises
     ------
     RuntimeError
-        If both docker compose and docker-compose commands fail
+        If the docker compose command fails
     """
-    cmd = ["docker", "compose", "up"]
-    if detach:
-        cmd.append("-d")
-    cmd.append(name)
-
-    try:
-        subprocess.run(cmd, check=True)
-    except subprocess.CalledProcessError:
-        cmd = ["docker-compose", "up"]
-        if detach:
-            cmd.append("-d")
-        cmd.append(name)
-        try:
-            subprocess.run(cmd, check=True)
-        except subprocess.CalledProcessError as e:
-            raise RuntimeError(f"Failed to start service {name}: {e}")
+    names = [names] if isinstance(names, str) else list(names)
+    args = ["up", "-d"] if detach else ["up"]
+    _compose(*args, *names, error=f"Failed to start service {' '.join(names)}")
 
 
 def stop_services() -> None:
@@ -184,228 +780,1799 @@ def stop_services() -> None:
     Raises
     ------
     RuntimeError
-        If both docker compose and docker-compose commands fail
+        If the docker compose command fails
     """
-    try:
-        subprocess.run(["docker", "compose", "down"], check=True)
-    except subprocess.CalledProcessError:
-        try:
-            subprocess.run(["docker-compose", "down"], check=True)
-        except subprocess.CalledProcessError as e:
-            raise RuntimeError(f"Failed to stop services: {e}")
+    _compose("down", error="Failed to stop services")
 
 
-def run_service(name: str, remove: bool = True) -> None:
-    """Run a given service
+def _engine():
+    """A client for the docker daemon's API, or None if it cannot be reached
+
+    The daemon is pinged on every call, which takes about a millisecond, so that
+    a long running command such as test --watch notices a daemon which has been
+    started, stopped or restarted, or a change to DOCKER_HOST.
+    """
+    from .docker_engine import DockerEngine
+
+    engine = DockerEngine()
+    return engine if engine.ping() else None
+
+
+def _compose_project_name() -> str:
+    """The name docker compose gives the project in the current directory"""
+    import re
+
+    from dotenv import dotenv_values
+
+    name = os.environ.get("COMPOSE_PROJECT_NAME")
+    name = name or dotenv_values(".env").get("COMPOSE_PROJECT_NAME")
+    if name:
+        return name
+    for file in COMPOSE_FILES:
+        if Path(file).exists():
+            name = (_load_yaml(file) or {}).get("name")
+            break
+    return name or re.sub(r"[^a-z0-9_-]", "", Path.cwd().name.lower())
+
+
+def _service_containers(engine) -> Dict[str, Dict]:
+    """The details of the project's containers by service"""
+    labels = {"com.docker.compose.project": _compose_project_name()}
+    containers = engine.containers(labels, all=True)
+    # Containers started by compose run are labelled as oneoff
+    return {
+        c["Labels"]["com.docker.compose.service"]: engine.inspect(c["Id"])
+        for c in containers
+        if c["Labels"].get("com.docker.compose.oneoff", "False") == "False"
+    }
+
+
+def service_status(services: Iterable[str] = ("app", "db")) -> Dict[str, Dict]:
+    """The state of the project's services
 
     Parameters
     ----------
-    name
-        The name of the service to start
-    remove
-        Whether to remove the container after running
+    services
+        The names of the services
+
+    Returns
+    -------
+    Dict[str, Dict]
+        The container id, state, health and start time of each service which has
+        a container. Health is None for containers without a healthcheck.
 
     Raises
     ------
     RuntimeError
-        If both docker compose and docker-compose commands fail
+        If the docker daemon cannot be queried
+    """
+    engine = _engine()
+    if engine is None:
+        raise RuntimeError("Cannot reach the docker daemon")
+    containers = _service_containers(engine)
+    status = {}
+    for service in services:
+        if containers.get(service) is None:
+            continue
+        state = containers[service]["State"]
+        status[service] = {
+            "id": containers[service]["Id"],
+            "state": state["Status"],
+            "health": state.get("Health", {}).get("Status"),
+            "started": state["StartedAt"],
+        }
+    return status
+
+
+def services_are_current(services: Iterable[str] = ("app", "db")) -> bool:
+    """Whether the services are running and started after their configuration
+    last changed, so that starting them again would do nothing
+
+    Returns False, rather than raising, if the docker daemon cannot be queried.
     """
-    cmd = ["docker", "compose", "run"]
-    if remove:
-        cmd.append("--rm")
-    cmd.append(name)
+    from datetime import datetime
 
     try:
-        subprocess.run(cmd, check=True)
-    except subprocess.CalledProcessError:
-        cmd = ["docker-compose", "run"]
-        if remove:
-            cmd.append("--rm")
-        cmd.append(name)
-        try:
-            subprocess.run(cmd, check=True)
-        except subprocess.CalledProcessError as e:
-            raise RuntimeError(f"Failed to run service {name}: {e}")
-
-
-class AmoniRemoteCallbacks(pygit2.RemoteCallbacks):
-    def credentials(self, url, user, allowed_types):
-        if allowed_types & pygit2.credentials.GIT_CREDENTIAL_SSH_KEY:
-            credentials = {
-                key: keyring.get_password(url, key)
-                for key in ("username", "pubkey", "privkey", "passphrase")
-            }
-            if user is not None:
-                credentials["username"] = user
-            return pygit2.Keypair(**credentials)
+        status = service_status(services)
+    except RuntimeError:
+        return False
+    overrides = [
+        Path(f"{Path(f).stem}.override{Path(f).suffix}") for f in COMPOSE_FILES
+    ]
+    configuration = [*COMPOSE_FILES, *overrides, ".env", ANVIL_CONFIG_FILE]
+    configuration.append(Path("app", "requirements.txt"))
+    changed = max(
+        (os.stat(path).st_mtime for path in configuration if Path(path).exists()),
+        default=0,
+    )
+    for service in services:
+        if service not in status or status[service]["state"] != "running":
+            return False
+        if status[service]["health"] not in (None, "healthy"):
+            return False
+        # Docker reports nanoseconds, which datetime cannot parse
+        started = status[service]["started"].split(".")[0].rstrip("Z")
+        started = datetime.fromisoformat(f"{started}+00:00").timestamp()
+        if started < changed:
+            return False
+    return True
+
+
+def _service_container(engine, service: str) -> str:
+    """The id of the running container of a service, if there is one"""
+    if engine is None:
         return None
+    details = _service_containers(engine).get(service)
+    if details is None or not details["State"]["Running"]:
+        return None
+    return details["Id"]
 
 
-def add_submodule(url: str, path: Path, name: str) -> None:
-    """Add a submodule to the current repository
+def stream_logs(
+    service: str, output: Callable[[bytes], None], follow: bool = False, tail="all"
+) -> None:
+    """Pass the logs of a service to a function as they arrive
 
     Parameters
     ----------
-    url
-        The url of the submodule to add
-    path
-        The directory where the submodule should be added
-    name
-        The name of the submodule
+    service
+        The name of the service
+    output
+        Called with each chunk of the logs
+    follow
+        Whether to keep waiting for further logs
+    tail
+        The number of lines from the end of the logs to start with, or "all"
+
+    Raises
+    ------
+    RuntimeError
+        If the logs cannot be read
     """
-    repo = pygit2.Repository(".")
-    repo.add_submodule(url, path, callbacks=AmoniRemoteCallbacks())
-    _commit_all(f"Add {name} submodule", repo=repo)
+    engine = _engine()
+    if engine is None:
+        # docker compose writes the logs to the terminal itself
+        args = ["logs", "--tail", str(tail), *(["--follow"] if follow else [])]
+        _compose(*args, service, error=f"Failed to read logs of {service}")
+        return
+    details = _service_containers(engine).get(service)
+    if details is None:
+        raise RuntimeError(f"There is no container for {service}")
+    for _, data in engine.logs(details["Id"], follow=follow, tail=str(tail)):
+        output(data)
 
 
-def set_app(name: str) -> None:
-    """Set the app to be run by the anvil app server
+def _write_stream(stream: int, data: bytes) -> None:
+    """Write output from a container to stdout or stderr"""
+    import sys
 
-    Parameters
-    ----------
-    name
-        The name of the app
-    """
-    anvil_config = load(ANVIL_CONFIG_FILE.open(), Loader=Loader)
-    anvil_config["app"] = Path("/", "app", name).as_posix()
-    dump(anvil_config, ANVIL_CONFIG_FILE.open("w"), Dumper=Dumper)
-    _commit_all(f"Set {name} as the anvil app")
+    target = sys.stderr if stream == 2 else sys.stdout
+    target.buffer.write(data)
+    target.flush()
 
 
-def set_dependency(id: str, name: str) -> None:
-    """Set an app to be a dependency
+def run_service(name: str, remove: bool = True, command: List[str] = ()) -> None:
+    """Run a given service
 
     Parameters
     ----------
-    id
-        The id of the dependency app
     name
-        The name of the dependency app
+        The name of the service to start
+    remove
+        Whether to remove the container after running
+    command
+        The command to run in place of the service's default
+
+    Raises
+    ------
+    RuntimeError
+        If the docker compose command fails
     """
-    anvil_config = load(ANVIL_CONFIG_FILE.open(), Loader=Loader)
-    try:
-        anvil_config["dep-id"][id] = name
-    except KeyError:
-        anvil_config["dep-id"] = {id: name}
-    dump(anvil_config, ANVIL_CONFIG_FILE.open("w"), Dumper=Dumper)
-    _commit_all(f"Set {name} as a dependency")
+    args = ["run", "--rm"] if remove else ["run"]
+    _compose(*args, name, *command, error=f"Failed to run service {name}")
 
 
-def generate_table_stubs(app: str, target: Path = TABLE_STUB_FILE) -> None:
-    """Generate stub entries for app tables in anvil.yaml
+def _project_cache_dir() -> Path:
+    """The cache directory for the amoni project in the current directory"""
+    import hashlib
 
-    Parameters
-    ----------
-    app
-        The name of the app
-    target
-        The stub file where the entries should be added
-    """
-    config = _get_app_config(app)
-    try:
-        tables = config["db_schema"]
-    except KeyError:
-        return False
-    table_definition = [f"{t}: Table\n" for t in tables]
-    content = ["from anvil.tables import Table\n\n"] + table_definition
-    with Path(target).open("w") as f:
-        f.truncate(0)
-        f.writelines(content)
-    return True
+    project = str(Path.cwd().resolve())
+    return _cache_dir() / "projects" / hashlib.sha1(project.encode()).hexdigest()
 
 
-def build_theme(app: str) -> None:
-    """Build the theme for the given app
+def _test_durations_file() -> Path:
+    return _project_cache_dir() / "test_durations.json"
 
-    Parameters
-    ----------
-    app
-        The name of the app
+
+def collect_tests() -> List[str]:
+    """Collect the test node ids within the test runner container
+
+    Returns
+    -------
+    List[str]
+        The pytest node ids, relative to the container's root directory
 
     Raises
     ------
     RuntimeError
-        If both docker compose and docker-compose commands fail
+        If the tests cannot be collected
     """
-    try:
-        subprocess.run(
-            ["docker", "compose", "run", "--rm", "theme_builder", app], check=True
-        )
-    except subprocess.CalledProcessError:
-        try:
-            subprocess.run(
-                ["docker-compose", "run", "--rm", "theme_builder", app], check=True
-            )
-        except subprocess.CalledProcessError as e:
-            raise RuntimeError(f"Failed to build theme for {app}: {e}")
+    collect = ["run", "--rm", "-T", TEST_SERVICE, "pytest", "--collect-only", "-q"]
+    error = "Failed to collect tests"
+    result = _compose(*collect, error=error, capture_output=True, text=True)
+    return [line for line in result.stdout.splitlines() if "::" in line]
 
 
-def add_table(
-    app: str,
-    name: str,
-    client_permissions: str = "none",
-    server_permissions: str = "full",
-    columns: List = None,
-):
-    columns = [] if columns is None else columns
-    config = _get_app_config(app)
-    table = {
-        "title": name,
-        "client": client_permissions,
-        "server": server_permissions,
-        "columns": columns,
-    }
-    try:
-        config["db_schema"][name] = table
-    except KeyError:
-        config["db_schema"] = {name: table}
-    _save_app_config(app, config)
-    _commit_all(f"Add {name} data table")
+def _balance_shards(files: List[str], shards: int) -> List[List[str]]:
+    """Split test files into shards of similar recorded duration"""
+    import heapq
 
+    try:
+        durations = json.loads(_test_durations_file().read_text())
+    except (OSError, ValueError):
+        durations = {}
+    known = [durations[f] for f in files if f in durations]
+    default = sum(known) / len(known) if known else 1.0
+
+    # Assign the slowest files first, each to the currently quickest shard
+    heap = [(0.0, i) for i in range(shards)]
+    assigned = [[] for _ in range(shards)]
+    for file in sorted(files, key=lambda f: durations.get(f, default), reverse=True):
+        total, i = heapq.heappop(heap)
+        assigned[i].append(file)
+        heapq.heappush(heap, (total + durations.get(file, default), i))
+    return [shard for shard in assigned if shard]
+
+
+def _file_durations(suites: List, files: List[str]) -> Dict[str, float]:
+    """Total the junit testcase times of each test file"""
+    modules = {f[: -len(".py")].replace("/", "."): f for f in files}
+    durations = {}
+    for suite in suites:
+        for case in suite.iter("testcase"):
+            module = case.get("classname", "")
+            while module and module not in modules:
+                module = module.rpartition(".")[0]
+            if module:
+                file = modules[module]
+                durations[file] = durations.get(file, 0.0) + float(case.get("time", 0))
+    return durations
+
+
+def _run_shard(index: int, files: List[str], output: Callable, processes: Dict):
+    import xml.etree.ElementTree as ElementTree
+
+    cmd = [*compose_command(), "run", "--rm", "-T", TEST_SERVICE]
+    cmd += ["sh", "-c", SHARD_SCRIPT, "amoni-shard", *files]
+    process = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
+    )
+    processes[index] = process
+    report, in_report = [], False
+    for line in process.stdout:
+        if line.rstrip("\n") == JUNIT_MARKER:
+            in_report = True
+        elif in_report:
+            report.append(line)
+        else:
+            output(f"[shard {index + 1}] {line.rstrip()}")
+    status = process.wait()
+    try:
+        suite = ElementTree.fromstring("".join(report))
+    except ElementTree.ParseError:
+        suite = None
+    return status, suite
 
-def add_column(app: str, table: str, name: str, data_type: str, target: str = None):
-    config = _get_app_config(app)
-    column = {"name": name, "admin_ui": {"width": 200}, "type": data_type}
-    if not target:
-        column["target"] = target
-    config["db_schema"][table]["columns"].append(column)
-    _save_app_config(app, config)
-    _commit_all(f"Add {name} column to {table} data table")
 
+def run_tests_sharded(
+    shards: int, junitxml: Path = None, output: Callable = print, files=None
+) -> Dict:
+    """Run the test suite split across several test runner containers
 
-def checkout_version(app: str, version: str = None) -> None:
-    """Checkout a specific version (tag or branch) of a submodule
+    Test files are balanced across the shards using the durations recorded
+    from earlier runs. If any shard fails, the others are stopped.
 
     Parameters
     ----------
-    app : str
-        The name of the app (submodule)
-    version : str, optional
-        The version (tag or branch) to checkout. If not provided,
-        stays on default branch.
-    """
-    if not version:
-        return
+    shards
+        The number of containers to run concurrently
+    junitxml
+        Where to write the merged junit report, if anywhere
+    output
+        Called with each line of test output, prefixed by its shard
+    files
+        The test files to run. Defaults to every test collected.
 
-    app_path = Path("app", app)
+    Returns
+    -------
+    Dict
+        The exit status and the merged totals of tests, failures, errors,
+        skipped tests and time
 
+    Raises
+    ------
+    RuntimeError
+        If the tests cannot be collected
+    """
+    import xml.etree.ElementTree as ElementTree
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    if files is None:
+        files = sorted({node.split("::")[0] for node in collect_tests()})
+    assigned = _balance_shards(files, shards)
+    processes = {}
+    status = 0
+    suites = []
+    with ThreadPoolExecutor(max_workers=len(assigned) or 1) as executor:
+        remaining = {
+            executor.submit(_run_shard, i, shard, output, processes)
+            for i, shard in enumerate(assigned)
+        }
+        while remaining:
+            finished, remaining = wait(remaining, return_when=FIRST_COMPLETED)
+            for future in finished:
+                shard_status, suite = future.result()
+                if suite is not None:
+                    suites.extend(suite.iter("testsuite"))
+                if shard_status != 0 and status == 0:
+                    status = shard_status
+                    for process in processes.values():
+                        if process.poll() is None:
+                            process.terminate()
+
+    totals = {"tests": 0, "failures": 0, "errors": 0, "skipped": 0, "time": 0.0}
+    merged = ElementTree.Element("testsuites")
+    for i, suite in enumerate(suites):
+        suite.set("name", f"shard-{i + 1}")
+        for key in totals:
+            totals[key] += type(totals[key])(suite.get(key, 0))
+        merged.append(suite)
+    for key, value in totals.items():
+        merged.set(key, str(value))
+    if junitxml is not None:
+        ElementTree.ElementTree(merged).write(junitxml, encoding="utf-8")
+
+    durations_file = _test_durations_file()
     try:
-        subprocess.run(
-            ["git", "fetch", "--tags"],
-            cwd=app_path,
-            check=True,
-            capture_output=True,
-            text=True,
-        )
+        durations = json.loads(durations_file.read_text())
+    except (OSError, ValueError):
+        durations = {}
+    durations.update(_file_durations(suites, files))
+    durations_file.parent.mkdir(parents=True, exist_ok=True)
+    durations_file.write_text(json.dumps(durations))
 
-        subprocess.run(
-            ["git", "checkout", version],
-            cwd=app_path,
-            check=True,
-            capture_output=True,
-            text=True,
+    return {"status": status, **totals}
+
+
+def _test_runner_name() -> str:
+    return f"amoni-test-runner-{_project_cache_dir().name[:12]}"
+
+
+def _container_state(name: str) -> bool:
+    """Whether a container is running, or None if there is no such container"""
+    engine = _engine()
+    if engine is not None:
+        details = engine.inspect(name)
+        return None if details is None else details["State"]["Running"]
+    inspect = ["docker", "inspect", "--format", "{{.State.Running}}", name]
+    state = subprocess.run(inspect, capture_output=True, text=True)
+    return state.stdout.strip() == "true" if state.returncode == 0 else None
+
+
+def _remove_container(name: str) -> None:
+    engine = _engine()
+    if engine is not None:
+        engine.remove(name)
+    else:
+        subprocess.run(["docker", "rm", "-f", name], capture_output=True)
+
+
+def start_test_runner() -> str:
+    """Start a test runner container which stays running between test runs
+
+    If the container is already running, it is reused.
+
+    Returns
+    -------
+    str
+        The name of the container
+
+    Raises
+    ------
+    RuntimeError
+        If the container cannot be started
+    """
+    name = _test_runner_name()
+    running = _container_state(name)
+    if running:
+        return name
+    if running is not None:
+        _remove_container(name)
+    run = ["run", "-d", "--name", name, TEST_SERVICE, "sleep", "infinity"]
+    error = "Failed to start the test runner"
+    _compose(*run, error=error, stdout=subprocess.DEVNULL)
+    return name
+
+
+def stop_test_runner() -> None:
+    """Stop and remove the test runner container started by start_test_runner"""
+    _remove_container(_test_runner_name())
+
+
+def run_tests_in_runner(args: List[str] = ()) -> int:
+    """Run pytest within the test runner container, starting it if necessary
+
+    Parameters
+    ----------
+    args
+        Arguments for pytest, such as the test files to run
+
+    Returns
+    -------
+    int
+        The exit status of pytest
+    """
+    import sys
+
+    name = start_test_runner()
+    engine = _engine()
+    if engine is not None:
+        command = ["pytest", *args]
+        return engine.exec(name, command, _write_stream, tty=sys.stdout.isatty())
+    tty = ["-t"] if sys.stdout.isatty() else []
+    return subprocess.run(["docker", "exec", *tty, name, "pytest", *args]).returncode
+
+
+def _is_test_file(path: Path) -> bool:
+    return path.suffix == ".py" and (
+        path.name.startswith("test_") or path.stem.endswith("_test")
+    )
+
+
+def _test_watch_job(path: str) -> Tuple[str, str]:
+    """Whether a changed path is a test file or app source, if either"""
+    try:
+        path = Path(path).resolve().relative_to(Path.cwd().resolve())
+    except ValueError:
+        return None
+    parts = path.parts
+    if (
+        not parts
+        or parts[0] == TABLE_STUB_DIR.parts[0]
+        or parts[-1].endswith("~")
+        or any(part.startswith(".") for part in parts)
+    ):
+        return None
+    if _is_test_file(path):
+        return "test", path.as_posix()
+    if parts[0] == "app" and path.suffix in (".py", ".yaml"):
+        return "app", path.as_posix()
+    return None
+
+
+def watch_tests(
+    callback: Callable = None, debounce: float = WATCH_DEBOUNCE, stop=None
+) -> None:
+    """Re-run tests in the test runner container whenever files change
+
+    Only the test modules affected by the changes are run, as chosen by
+    :func:`amoni.selection.select_tests`.
+
+    Parameters
+    ----------
+    callback
+        Called as callback(args, status) after each run with the pytest
+        arguments used and its exit status
+    debounce
+        The number of seconds without further changes to wait before running
+    stop
+        A threading.Event which stops the watch when set. Without one, the watch
+        runs until interrupted.
+    """
+    from .selection import select_tests
+
+    callback = callback or (lambda args, status: None)
+
+    def run(jobs):
+        tests = select_tests(path for _, path in jobs)
+        if tests != []:
+            args = tests or []
+            callback(args, run_tests_in_runner(args))
+
+    start_test_runner()
+    _watch_events(".", _test_watch_job, run, debounce, stop)
+
+
+def _app_is_ready(host: str, port: str) -> bool:
+    import http.client
+
+    # Any HTTP response, even an error status, means the app server is serving.
+    # Connect directly, as a proxy would answer on its behalf.
+    connection = http.client.HTTPConnection(host, int(port), timeout=2)
+    try:
+        connection.request("GET", "/")
+        connection.getresponse().close()
+    except (OSError, ValueError, http.client.HTTPException):
+        return False
+    finally:
+        connection.close()
+    return True
+
+
+def _db_is_ready(host: str, port: str) -> bool:
+    import socket
+    import struct
+
+    # Docker accepts connections on a published port before the container is
+    # listening, so send a postgres SSLRequest and wait for its one byte answer
+    try:
+        with socket.create_connection((host, int(port)), timeout=2) as connection:
+            connection.sendall(struct.pack("!II", 8, 80877103))
+            return connection.recv(1) in (b"S", b"N")
+    except OSError:
+        return False
+
+
+def _wait_until(probe, deadline: float) -> float:
+    started = time.monotonic()
+    delay = 0.05
+    while not probe():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 1)
+    return time.monotonic() - started
+
+
+def wait_for_services(
+    services: Tuple[str, ...] = ("app", "db"),
+    timeout: float = READY_TIMEOUT,
+    host: str = "localhost",
+) -> Dict[str, float]:
+    """Wait until the app and database servers accept requests
+
+    The services are polled concurrently with an exponential backoff and the
+    call returns as soon as all of them are ready.
+
+    Parameters
+    ----------
+    services
+        The services to wait for, any of "app" and "db"
+    timeout
+        The maximum number of seconds to wait
+    host
+        The host on which the service ports are published
+
+    Returns
+    -------
+    Dict[str, float]
+        The number of seconds each service took to become ready
+
+    Raises
+    ------
+    RuntimeError
+        If any service is not ready within the timeout
+    """
+    app_port, db_port, _, _ = get_ports()
+    probes = {
+        "app": lambda: _app_is_ready(host, app_port),
+        "db": lambda: _db_is_ready(host, db_port),
+    }
+    from concurrent.futures import ThreadPoolExecutor
+
+    deadline = time.monotonic() + timeout
+    with ThreadPoolExecutor(max_workers=len(services) or 1) as executor:
+        futures = {
+            service: executor.submit(_wait_until, probes[service], deadline)
+            for service in services
+        }
+        timings, failed = {}, []
+        for service, future in futures.items():
+            try:
+                timings[service] = future.result()
+            except TimeoutError:
+                failed.append(service)
+    if failed:
+        raise RuntimeError(
+            f"Timed out after {timeout:g}s waiting for {', '.join(failed)} to be ready"
         )
-    except subprocess.CalledProcessError as e:
+    return timings
+
+
+def _compose_config() -> Dict:
+    """The project's docker compose configuration with overrides applied"""
+    import yaml
+
+    config = _compose(
+        "config", error="Failed to read compose config", capture_output=True, text=True
+    )
+    return yaml.safe_load(config.stdout)
+
+
+def _docker_resources() -> Tuple[int, int]:
+    """The number of CPUs and bytes of memory available to containers"""
+    info = ["docker", "info", "--format", "{{.NCPU}} {{.MemTotal}}"]
+    try:
+        output = subprocess.run(info, check=True, capture_output=True, text=True)
+        cpus, memory = output.stdout.split()
+        return int(cpus), int(memory)
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        pass
+    # Containers on Linux share the host's resources
+    try:
+        memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        memory = 4 * 2**30
+    return os.cpu_count() or 1, memory
+
+
+def _memory_bytes(value) -> int:
+    """The bytes in a docker memory size such as 512m or 2gb"""
+    text = str(value).strip().lower().rstrip("b")
+    units = {"k": 2**10, "m": 2**20, "g": 2**30, "t": 2**40}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def _app_memory_limit() -> int:
+    """The bytes of memory the app container may use"""
+    service = _compose_config()["services"].get(APP_SERVICE, {})
+    limits = service.get("deploy", {}).get("resources", {}).get("limits", {})
+    limit = service.get("mem_limit") or limits.get("memory")
+    return _memory_bytes(limit) if limit else _docker_resources()[1]
+
+
+def server_settings(preset: str = "dev", **overrides) -> Dict:
+    """The settings for the app server of a preset
+
+    Parameters
+    ----------
+    preset
+        "dev" or "load-test"
+    **overrides
+        Values replacing those of the preset for any of heap_mb, workers,
+        worker_memory_mb, worker_timeout and app_cache_size
+
+    Returns
+    -------
+    Dict
+        The settings
+
+    Raises
+    ------
+    RuntimeError
+        If the preset or a setting is unknown
+    """
+    try:
+        settings = dict(SERVER_PRESETS[preset])
+    except KeyError:
+        presets = ", ".join(SERVER_PRESETS)
+        raise RuntimeError(f"Unknown preset {preset}. Use one of {presets}")
+    unknown = set(overrides) - set(settings)
+    if unknown:
+        raise RuntimeError(f"Unknown settings {', '.join(sorted(unknown))}")
+    settings.update({k: v for k, v in overrides.items() if v is not None})
+    return settings
+
+
+def tune_server(preset: str = "dev", **overrides) -> Dict:
+    """Set the JVM heap and python worker limits of the app server
+
+    The settings are written to the app service's environment in the project's
+    docker compose override file and take effect when the app server next
+    starts. The JVM heap is set through JAVA_TOOL_OPTIONS and the workers which
+    run server code are configured through the variables they read. Each server
+    call runs in its own worker, so workers is the number of calls expected to
+    run at once and is used to check the memory needed.
+
+    Parameters
+    ----------
+    preset
+        "dev" or "load-test"
+    **overrides
+        See :func:`server_settings`
+
+    Returns
+    -------
+    Dict
+        The settings
+
+    Raises
+    ------
+    RuntimeError
+        If the settings need more memory than the app container may use
+    """
+    settings = server_settings(preset, **overrides)
+    needed = (
+        settings["heap_mb"]
+        + JVM_OVERHEAD_MB
+        + settings["workers"] * settings["worker_memory_mb"]
+    )
+    limit = _app_memory_limit() // 2**20
+    if needed > limit:
         raise RuntimeError(
-            f"Failed to checkout version '{version}' in {app}: {e.stderr}"
+            f"The settings need {needed}MB but the app container may only use "
+            f"{limit}MB. Reduce the heap, workers or worker memory."
+        )
+    environment = {
+        "JAVA_TOOL_OPTIONS": (
+            f"-Xms{settings['heap_mb']}m -Xmx{settings['heap_mb']}m -XX:+UseG1GC"
+        ),
+        "PER_WORKER_SOFT_MEMORY_LIMIT_MB": str(settings["worker_memory_mb"]),
+        "DOWNLINK_WORKER_TIMEOUT": str(settings["worker_timeout"]),
+        "APP_CACHE_SIZE": str(settings["app_cache_size"]),
+    }
+    with Project(f"Tune the app server for {preset}") as project:
+        project.set_environment(APP_SERVICE, environment)
+    return settings
+
+
+@lru_cache(maxsize=None)
+def _remote_callbacks_class():
+    import keyring
+    import pygit2
+
+    class AmoniRemoteCallbacks(pygit2.RemoteCallbacks):
+        def credentials(self, url, user, allowed_types):
+            if allowed_types & pygit2.credentials.GIT_CREDENTIAL_SSH_KEY:
+                credentials = {
+                    key: keyring.get_password(url, key)
+                    for key in ("username", "pubkey", "privkey", "passphrase")
+                }
+                if user is not None:
+                    credentials["username"] = user
+                return pygit2.Keypair(**credentials)
+            return None
+
+    AmoniRemoteCallbacks.__module__ = __name__
+    return AmoniRemoteCallbacks
+
+
+def __getattr__(name):
+    # AmoniRemoteCallbacks subclasses a pygit2 class, so it is only created
+    # when first requested
+    if name == "AmoniRemoteCallbacks":
+        return _remote_callbacks_class()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _app_mirror(url: str) -> Path:
+    """A bare mirror of an app's repository in the user cache directory
+
+    Mirrors are shared by all of the user's amoni projects and fetched at most
+    once every AMONI_APP_MIRROR_TTL seconds. If a fetch fails, for example when
+    offline, the mirror is used as it is. If the repository cannot be mirrored,
+    it is not tried again for as long.
+
+    Returns
+    -------
+    Path
+        The mirror, or None if the repository cannot be mirrored
+    """
+    import hashlib
+    import tempfile
+
+    cache = _cache_dir() / "apps" / hashlib.sha1(url.encode()).hexdigest()
+    mirror = cache / "mirror.git"
+    fetched = cache / "fetched"
+    failed = cache / "failed"
+    if not mirror.exists():
+        if failed.exists() and time.time() - failed.stat().st_mtime < APP_MIRROR_TTL:
+            return None
+        cache.mkdir(parents=True, exist_ok=True)
+        staging = Path(tempfile.mkdtemp(dir=cache, prefix=".clone-"))
+        error = f"Failed to mirror {url}"
+        try:
+            _git("clone", "--mirror", "--quiet", url, str(staging), error=error)
+            os.replace(staging, mirror)
+        except RuntimeError:
+            shutil.rmtree(staging, ignore_errors=True)
+            failed.touch()
+            return None
+        except OSError:
+            # Another process created the mirror first
+            shutil.rmtree(staging, ignore_errors=True)
+        fetched.touch()
+        failed.unlink(missing_ok=True)
+    elif not fetched.exists() or time.time() - fetched.stat().st_mtime > APP_MIRROR_TTL:
+        try:
+            _git(
+                "fetch", "--quiet", "origin", cwd=mirror, error=f"Failed to fetch {url}"
+            )
+            fetched.touch()
+        except RuntimeError:
+            pass
+    return mirror
+
+
+def _clone_from_mirror(url: str, path: Path) -> bool:
+    """Clone a repository from its mirror
+
+    The clone hard links the mirror's object files where they are on the same
+    filesystem and copies them otherwise, so it does not depend on the mirror,
+    which can be removed along with the rest of the cache.
+
+    Returns
+    -------
+    bool
+        Whether the repository could be mirrored
+    """
+    mirror = _app_mirror(url)
+    if mirror is None:
+        return False
+    error = f"Failed to clone {url} into {path}"
+    _git("clone", "--local", "--quiet", str(mirror), str(path), error=error)
+    _git("remote", "set-url", "origin", url, cwd=path, error=error)
+    return True
+
+
+def _clone(url: str, path: Path, depth: int = None, filter: str = None) -> None:
+    """Clone a repository, keeping only depth commits of history and leaving out
+    the objects excluded by filter
+
+    Full clones come from the user's mirror of the repository where possible.
+    libgit2 cannot make partial clones, so those use the git command instead.
+    """
+    import pygit2
+
+    if not (depth or filter) and _clone_from_mirror(url, path):
+        return
+    if filter:
+        options = [f"--filter={filter}", *([f"--depth={depth}"] if depth else [])]
+        _git("clone", *options, url, str(path), error=f"Failed to clone {url}")
+        return
+    options = {"depth": depth} if depth else {}
+    try:
+        pygit2.clone_repository(
+            url, str(path), callbacks=_remote_callbacks_class()(), **options
+        )
+    except pygit2.GitError as e:
+        raise RuntimeError(f"Failed to clone {url} into {path}: {e}")
+
+
+def _absorb_git_dirs(paths: Iterable[str]) -> None:
+    """Move the repositories of submodules into .git/modules, where git keeps
+    those it clones itself, leaving a .git file in each submodule"""
+    absorb = ("submodule", "absorbgitdirs", "--", *paths)
+    _git(*absorb, error="Failed to move submodule repositories into .git/modules")
+
+
+def _set_clone_options(
+    gitmodules, submodule: str, depth: int = None, filter: str = None
+) -> None:
+    """Record in .gitmodules how a submodule was cloned, so that later clones match
+
+    git itself uses the shallow setting with ``git submodule update
+    --recommend-shallow``.
+    """
+    if depth:
+        gitmodules[f"submodule.{submodule}.shallow"] = True
+        gitmodules[f"submodule.{submodule}.depth"] = depth
+    if filter:
+        gitmodules[f"submodule.{submodule}.filter"] = filter
+
+
+def add_submodule(
+    url: str, path: Path, name: str, depth: int = None, filter: str = None
+) -> None:
+    """Add a submodule to the current repository
+
+    Unless depth or filter are given, the submodule is cloned from the user's
+    mirror of its repository, see :func:`_app_mirror`.
+
+    Parameters
+    ----------
+    url
+        The url of the submodule to add
+    path
+        The directory where the submodule should be added
+    name
+        The name of the submodule
+    depth
+        The number of commits of history to fetch. Defaults to all of them.
+    filter
+        A git object filter, such as blob:none, for a partial clone whose
+        missing objects are fetched when needed
+
+    Raises
+    ------
+    RuntimeError
+        If the app cannot be cloned
+    """
+    import pygit2
+
+    submodule = Path(path).as_posix()
+    _clone(url, path, depth, filter)
+    # git adopts the existing clone rather than cloning again
+    _git("submodule", "add", url, submodule, error=f"Failed to add {name}")
+    _absorb_git_dirs([submodule])
+    repo = pygit2.Repository(".")
+    gitmodules = pygit2.Config(str(Path(repo.workdir, ".gitmodules")))
+    _set_clone_options(gitmodules, submodule, depth, filter)
+    _commit(f"Add {name} submodule", [".gitmodules", path], repo=repo)
+
+
+class Project:
+    """A batch of edits to the configuration of an amoni project
+
+    app/config.yaml, each app's anvil.yaml and amoni's other project files are
+    loaded at most once and edited in memory. On leaving the context, the changed
+    files are written and committed together.
+
+    Parameters
+    ----------
+    message
+        The commit message. Defaults to the combined messages of the edits.
+
+    Examples
+    --------
+    >>> with Project() as project:
+    ...     project.add_table("my_app", "books")
+    ...     project.add_column("my_app", "books", "title", "string")
+    """
+
+    def __init__(self, message: str = None):
+        self.message = message
+        self.messages = []
+        self._anvil_config = None
+        self._app_configs = {}
+        self._files = {}
+        # The paths, relative to the project root, of the files edited
+        self._changed = set()
+        self._paths = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+    @property
+    def anvil_config(self) -> Dict:
+        """The contents of app/config.yaml"""
+        if self._anvil_config is None:
+            self._anvil_config = _get_anvil_config()
+        return self._anvil_config
+
+    def app_config(self, app: str) -> Dict:
+        """The contents of the given app's anvil.yaml"""
+        if app not in self._app_configs:
+            self._app_configs[app] = _get_app_config(app)
+        return self._app_configs[app]
+
+    def _yaml_file(self, path: Path) -> Dict:
+        if path not in self._files:
+            try:
+                self._files[path] = _load_yaml(path) or {}
+            except FileNotFoundError:
+                self._files[path] = {}
+        return self._files[path]
+
+    @property
+    def indexes(self) -> Dict:
+        """The data table indexes recorded in db/indexes.yaml"""
+        return self._yaml_file(DB_INDEX_FILE)
+
+    @property
+    def compose_override(self) -> Dict:
+        """The contents of the project's docker compose override file"""
+        return self._yaml_file(_compose_override_file())
+
+    def stage(self, *paths) -> None:
+        """Include further paths, relative to the project root, in the commit"""
+        self._paths.update(paths)
+
+    def _changed_anvil_config(self, message: str) -> None:
+        self._changed.add(ANVIL_CONFIG_FILE)
+        self.messages.append(message)
+
+    def _changed_app_config(self, app: str, message: str) -> None:
+        self._changed.add(Path("app", app, "anvil.yaml"))
+        self.messages.append(message)
+
+    def set_app(self, name: str) -> None:
+        """Set the app to be run by the anvil app server"""
+        self.anvil_config["app"] = Path("/", "app", name).as_posix()
+        self._changed_anvil_config(f"Set {name} as the anvil app")
+
+    def set_dependency(self, id: str, name: str) -> None:
+        """Set an app to be a dependency"""
+        try:
+            self.anvil_config["dep-id"][id] = name
+        except KeyError:
+            self.anvil_config["dep-id"] = {id: name}
+        self._changed_anvil_config(f"Set {name} as a dependency")
+
+    def add_table(
+        self,
+        app: str,
+        name: str,
+        client_permissions: str = "none",
+        server_permissions: str = "full",
+        columns: List = None,
+    ) -> None:
+        """Add a data table to an app"""
+        config = self.app_config(app)
+        table = {
+            "title": name,
+            "client": client_permissions,
+            "server": server_permissions,
+            "columns": [] if columns is None else columns,
+        }
+        try:
+            config["db_schema"][name] = table
+        except KeyError:
+            config["db_schema"] = {name: table}
+        self._changed_app_config(app, f"Add {name} data table")
+
+    def add_column(
+        self, app: str, table: str, name: str, data_type: str, target: str = None
+    ) -> None:
+        """Add a column to a data table"""
+        column = {"name": name, "admin_ui": {"width": 200}, "type": data_type}
+        if target:
+            column["target"] = target
+        self.app_config(app)["db_schema"][table]["columns"].append(column)
+        self._changed_app_config(app, f"Add {name} column to {table} data table")
+
+    def add_index(self, app: str, table: str, column: str) -> None:
+        """Record an index on a column of a data table"""
+        columns = self.indexes.setdefault(app, {}).setdefault(table, [])
+        if column not in columns:
+            columns.append(column)
+            self._changed.add(DB_INDEX_FILE)
+            self.messages.append(f"Index {column} column of {table} data table")
+
+    def remove_index(self, app: str, table: str, column: str) -> None:
+        """Remove the record of an index on a column of a data table"""
+        tables = self.indexes.get(app, {})
+        if column in tables.get(table, []):
+            tables[table].remove(column)
+            if not tables[table]:
+                del tables[table]
+            if not tables:
+                del self.indexes[app]
+            self._changed.add(DB_INDEX_FILE)
+            self.messages.append(f"Remove index on {column} column of {table}")
+
+    def set_postgres_settings(self, settings: Dict[str, str]) -> None:
+        """Set the server settings passed to postgres in the db service
+
+        A setting with a value of None is removed.
+        """
+        services = self.compose_override.setdefault("services", {})
+        service = services.setdefault(DB_SERVICE, {})
+        current = _postgres_settings(service.get("command", []))
+        current.update(settings)
+        options = [("-c", f"{k}={v}") for k, v in current.items() if v is not None]
+        if options:
+            service["command"] = ["postgres", *(arg for o in options for arg in o)]
+        else:
+            service.pop("command", None)
+        if not service:
+            del services[DB_SERVICE]
+        self._changed.add(_compose_override_file())
+        self.messages.append(f"Set {', '.join(settings)} for the db service")
+
+    def set_environment(self, service: str, environment: Dict[str, str]) -> None:
+        """Set environment variables of a service"""
+        services = self.compose_override.setdefault("services", {})
+        current = services.setdefault(service, {}).setdefault("environment", {})
+        current.update(environment)
+        self._changed.add(_compose_override_file())
+        self.messages.append(f"Set {', '.join(environment)} for the {service} service")
+
+    def mount_db_config(self) -> None:
+        """Run postgres in the db service with amoni's configuration file
+
+        The file is chosen by AMONI_DB_PROFILE in .env.
+        """
+        services = self.compose_override.setdefault("services", {})
+        service = services.setdefault(DB_SERVICE, {})
+        volumes = service.get("volumes", [])
+        if DB_CONFIG_VOLUME not in volumes:
+            service["volumes"] = [*volumes, DB_CONFIG_VOLUME]
+        # Parallel queries use shared memory beyond docker's default of 64MB
+        service["shm_size"] = "1gb"
+        self.set_postgres_settings({"config_file": DB_CONFIG_TARGET})
+
+    def commit(self) -> None:
+        """Write the changed files and commit them"""
+        if not self._changed and not self._paths:
+            return
+        apps = {Path("app", app, "anvil.yaml"): app for app in self._app_configs}
+        for path in self._changed:
+            if path == ANVIL_CONFIG_FILE:
+                _dump_yaml(self._anvil_config, path)
+            elif path in apps:
+                _save_app_config(apps[path], self._app_configs[apps[path]])
+            else:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                _dump_yaml(self._files[path], path)
+        self._paths.update(self._changed)
+
+        if self.message is not None:
+            message = self.message
+        elif len(self.messages) == 1:
+            message = self.messages[0]
+        else:
+            details = "".join(f"* {m}\n" for m in self.messages)
+            message = f"Update project configuration\n\n{details}"
+        _commit(message, self._paths)
+        self._changed.clear()
+        self._paths.clear()
+        self.messages.clear()
+
+
+def set_app(name: str) -> None:
+    """Set the app to be run by the anvil app server
+
+    Parameters
+    ----------
+    name
+        The name of the app
+    """
+    with Project() as project:
+        project.set_app(name)
+
+
+def set_dependency(id: str, name: str) -> None:
+    """Set an app to be a dependency
+
+    Parameters
+    ----------
+    id
+        The id of the dependency app
+    name
+        The name of the dependency app
+    """
+    with Project() as project:
+        project.set_dependency(id, name)
+
+
+def _stub_class_name(table: str) -> str:
+    return "".join(part[:1].upper() + part[1:] for part in table.split("_"))
+
+
+def _column_stub_type(column: Dict, row_classes: Dict[str, str]) -> str:
+    data_type = column.get("type")
+    if data_type in ("link_single", "link_multiple"):
+        row_class = row_classes.get(column.get("target"))
+        row_type = f'"{row_class}"' if row_class else "_Row"
+        return f"_List[{row_type}]" if data_type == "link_multiple" else row_type
+    return COLUMN_TYPES.get(data_type, "_Any")
+
+
+def _table_stubs(tables: Dict) -> str:
+    """The stub module for the given db_schema tables"""
+    row_classes = {name: f"{_stub_class_name(name)}Row" for name in tables}
+    lines = [STUB_HEADER]
+    for name, table in tables.items():
+        row_class = row_classes[name]
+        table_class = f"{_stub_class_name(name)}Table"
+        columns = table.get("columns") or []
+        lines.append(f"\n\nclass {row_class}(_Row):")
+        for column in columns:
+            column_type = _column_stub_type(column, row_classes)
+            lines.append("    @_overload")
+            lines.append(
+                f"    def __getitem__(self, column: _Literal[{json.dumps(column['name'])}])"
+                f" -> _Optional[{column_type}]: ..."
+            )
+        if columns:
+            lines.append("    @_overload")
+        lines.append("    def __getitem__(self, column: str) -> _Any: ...")
+        lines.append(f"\n\nclass {table_class}(_Table):")
+        lines.append(
+            f"    def get(self, *args, **kwargs) -> _Optional[{row_class}]: ..."
         )
+        lines.append(
+            f"    def get_by_id(self, row_id: str) -> _Optional[{row_class}]: ..."
+        )
+        lines.append(f"    def add_row(self, **kwargs) -> {row_class}: ...")
+        lines.append(
+            f"    def search(self, *args, **kwargs) -> _Iterable[{row_class}]: ..."
+        )
+    lines.append("\n")
+    lines.extend(f"{name}: {_stub_class_name(name)}Table" for name in tables)
+    return "\n".join(lines) + "\n"
+
+
+def _write_if_changed(path: Path, content: str) -> bool:
+    """Write a file unless it already has the given content
+
+    Returns
+    -------
+    bool
+        Whether the file was written
+    """
+    import hashlib
+
+    path = Path(path)
+    new_hash = hashlib.sha256(content.encode()).digest()
+    try:
+        if hashlib.sha256(path.read_bytes()).digest() == new_hash:
+            return False
+    except FileNotFoundError:
+        path.parent.mkdir(parents=True, exist_ok=True)
+    _write_atomic(path, content)
+    return True
+
+
+def generate_table_stubs(app: str, target: Path = TABLE_STUB_FILE) -> bool:
+    """Generate typed stubs for the app tables in anvil.yaml
+
+    Each table gets a Row class, whose columns are typed from db_schema, and a
+    Table class. The target is only written if its content would change, so
+    that language servers do not needlessly reload it.
+
+    Parameters
+    ----------
+    app
+        The name of the app
+    target
+        The stub file where the entries should be added
+
+    Returns
+    -------
+    bool
+        Whether the stubs were written, which they are not if the app has no
+        db_schema or the stubs are unchanged
+    """
+    config = _get_app_config(app)
+    if "db_schema" not in config:
+        return False
+    tables = config["db_schema"] or {}
+    if isinstance(tables, list):
+        tables = {t.get("python_name") or t["name"]: t for t in tables}
+    return _write_if_changed(target, _table_stubs(tables))
+
+
+def _table_stub_targets() -> Dict[str, Path]:
+    targets = {_get_main_app(): TABLE_STUB_FILE}
+    for app in (_get_anvil_config().get("dep-id") or {}).values():
+        targets[app] = TABLE_STUB_DIR / f"{app}.pyi"
+    return targets
+
+
+def generate_all_table_stubs() -> Dict[str, Path]:
+    """Generate table stubs for the main app and each of its dependencies
+
+    The main app's stubs are written to TABLE_STUB_FILE and each dependency's
+    to its own module in TABLE_STUB_DIR.
+
+    Returns
+    -------
+    Dict[str, Path]
+        The stub file for each app whose stubs were written
+    """
+    return {
+        app: target
+        for app, target in _table_stub_targets().items()
+        if Path("app", app, "anvil.yaml").exists() and generate_table_stubs(app, target)
+    }
+
+
+def _service_image_id(service: str) -> str:
+    """The id of the local image for a compose service, if there is one"""
+    try:
+        config = _compose_config()
+    except RuntimeError:
+        return None
+    image = config["services"].get(service, {}).get("image")
+    if image is None:
+        # docker compose names the images it builds after the project and service,
+        # joined by _ in the older docker-compose
+        project = config.get("name") or _compose_project_name()
+        separator = "_" if compose_command() == ("docker-compose",) else "-"
+        image = f"{project}{separator}{service}"
+    engine = _engine()
+    if engine is not None:
+        try:
+            details = engine.image(image)
+        except RuntimeError:
+            return None
+        return details["Id"] if details else None
+    result = subprocess.run(
+        ["docker", "image", "inspect", "--format", "{{.Id}}", image],
+        capture_output=True,
+        text=True,
+    )
+    return result.stdout.strip() if result.returncode == 0 else None
+
+
+def _theme_hash(app: str, image_id: str) -> str:
+    import hashlib
+
+    theme = Path("app", app, "theme")
+    outputs = {Path("assets", "theme.css"), Path("assets", THEME_HASH_FILE)}
+    digest = hashlib.sha256(image_id.encode())
+    for path in sorted(theme.rglob("*")):
+        relative = path.relative_to(theme)
+        if path.is_file() and relative not in outputs:
+            digest.update(relative.as_posix().encode() + b"\0")
+            digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def theme_apps() -> List[str]:
+    """The names of the apps in the project which have a theme"""
+    return sorted(p.parent.name for p in Path("app").glob("*/theme") if p.is_dir())
+
+
+def build_theme(app: str, force: bool = False, image_id: str = None) -> bool:
+    """Build the theme for the given app
+
+    The theme sources and the theme_builder image id are hashed and the hash is
+    stored alongside the generated theme.css. If neither has changed since the
+    last build, no container is run.
+
+    Parameters
+    ----------
+    app
+        The name of the app
+    force
+        Whether to build the theme even if its sources are unchanged
+    image_id
+        The id of the theme_builder image, if already known
+
+    Returns
+    -------
+    bool
+        Whether the theme was built, rather than found to be up to date
+
+    Raises
+    ------
+    RuntimeError
+        If the docker compose command fails
+    """
+    assets = Path("app", app, "theme", "assets")
+    hash_file = assets / THEME_HASH_FILE
+    image_id = image_id or _service_image_id("theme_builder")
+    theme_hash = _theme_hash(app, image_id) if image_id else None
+    if (
+        not force
+        and theme_hash is not None
+        and Path(assets, "theme.css").exists()
+        and hash_file.exists()
+        and hash_file.read_text() == theme_hash
+    ):
+        return False
+
+    _compose(
+        "run", "--rm", "theme_builder", app, error=f"Failed to build theme for {app}"
+    )
+    if theme_hash is not None:
+        hash_file.write_text(theme_hash)
+    return True
+
+
+def build_themes(
+    apps: List[str] = None, force: bool = False, max_workers: int = SYNC_WORKERS
+) -> Dict[str, bool]:
+    """Build the themes for several apps concurrently
+
+    Parameters
+    ----------
+    apps
+        The names of the apps. Defaults to every app with a theme.
+    force
+        Whether to build the themes even if their sources are unchanged
+    max_workers
+        The maximum number of themes to build at the same time
+
+    Returns
+    -------
+    Dict[str, bool]
+        Whether each app's theme was built, rather than found to be up to date
+
+    Raises
+    ------
+    RuntimeError
+        If any of the builds fail
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    apps = theme_apps() if apps is None else apps
+    image_id = _service_image_id("theme_builder")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            app: executor.submit(build_theme, app, force, image_id) for app in apps
+        }
+        return {app: future.result() for app, future in futures.items()}
+
+
+def _watch_events(
+    directory: str, job_for_path: Callable, run_jobs: Callable, debounce: float, stop
+) -> None:
+    """Run jobs in response to filesystem events within a directory
+
+    job_for_path maps each changed path to a hashable job, or None to ignore
+    it. Once there have been no further events for debounce seconds, run_jobs
+    is called with the set of pending jobs.
+    """
+    import threading
+
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+
+    stop = stop or threading.Event()
+    pending = set()
+    changed = threading.Condition()
+    last_event = 0.0
+
+    class Handler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            nonlocal last_event
+            # Jobs read their sources and write their outputs, so ignore
+            # opened/closed events and directory modifications
+            if event.is_directory or event.event_type not in WATCHED_EVENTS:
+                return
+            paths = (event.src_path, getattr(event, "dest_path", ""))
+            jobs = {job for job in map(job_for_path, filter(None, paths)) if job}
+            if jobs:
+                with changed:
+                    pending.update(jobs)
+                    last_event = time.monotonic()
+                    changed.notify()
+
+    observer = Observer()
+    observer.schedule(Handler(), directory, recursive=True)
+    observer.start()
+    try:
+        while not stop.is_set():
+            with changed:
+                changed.wait_for(lambda: pending or stop.is_set(), timeout=1)
+                quiet = time.monotonic() - last_event
+                if not pending or quiet < debounce:
+                    changed.wait(debounce - quiet if pending else 0)
+                    continue
+                jobs = set(pending)
+                pending.clear()
+            run_jobs(jobs)
+    finally:
+        observer.stop()
+        observer.join()
+
+
+def _watch_job(path: str) -> Tuple[str, str]:
+    """The generator to run, and the app to run it for, when a path changes"""
+    try:
+        parts = Path(path).resolve().relative_to(Path("app").resolve()).parts
+    except ValueError:
+        return None
+    if len(parts) < 2 or parts[-1].startswith(".") or parts[-1].endswith("~"):
+        return None
+    app = parts[0]
+    if parts[1:] == ("anvil.yaml",):
+        return "stubs", app
+    if parts[1] == "theme" and parts[2:] != ("assets", "theme.css"):
+        return "theme", app
+    return None
+
+
+def _run_watch_jobs(jobs: set, callback: Callable) -> None:
+    from concurrent.futures import ThreadPoolExecutor
+
+    targets = _table_stub_targets()
+    with ThreadPoolExecutor(max_workers=SYNC_WORKERS) as executor:
+        futures = {}
+        for kind, app in sorted(jobs):
+            if kind == "stubs":
+                target = targets.get(app, TABLE_STUB_DIR / f"{app}.pyi")
+                futures[kind, app] = executor.submit(generate_table_stubs, app, target)
+            else:
+                futures[kind, app] = executor.submit(build_theme, app)
+        for (kind, app), future in futures.items():
+            try:
+                callback(kind, app, future.result())
+            except Exception as e:
+                callback(kind, app, e)
+
+
+def watch(
+    callback: Callable = None, debounce: float = WATCH_DEBOUNCE, stop=None
+) -> None:
+    """Regenerate table stubs and themes whenever their sources change
+
+    Changes under the app folder are received as filesystem events rather than
+    by polling. Bursts of events are debounced and coalesced per app, and only
+    the generators affected by the changes are run.
+
+    Parameters
+    ----------
+    callback
+        Called as callback(kind, app, result) after each generator has run,
+        where kind is "stubs" or "theme" and result is the generator's return
+        value or the exception it raised
+    debounce
+        The number of seconds without further events to wait before running
+    stop
+        A threading.Event which stops the watch when set. Without one, the watch
+        runs until interrupted.
+    """
+    callback = callback or (lambda kind, app, result: None)
+    _watch_events(
+        "app", _watch_job, lambda jobs: _run_watch_jobs(jobs, callback), debounce, stop
+    )
+
+
+def add_table(
+    app: str,
+    name: str,
+    client_permissions: str = "none",
+    server_permissions: str = "full",
+    columns: List = None,
+):
+    """Add a data table to an app
+
+    Parameters
+    ----------
+    app
+        The name of the app
+    name
+        The name of the table
+    client_permissions
+        The access forms have to the table
+    server_permissions
+        The access server modules have to the table
+    columns
+        The column definitions of the table
+    """
+    with Project() as project:
+        project.add_table(app, name, client_permissions, server_permissions, columns)
+
+
+def add_column(app: str, table: str, name: str, data_type: str, target: str = None):
+    """Add a column to a data table
+
+    Parameters
+    ----------
+    app
+        The name of the app
+    table
+        The name of the table
+    name
+        The name of the column
+    data_type
+        The anvil data type of the column
+    target
+        The name of the linked table for link columns
+    """
+    with Project() as project:
+        project.add_column(app, table, name, data_type, target)
+
+
+def _has_commit(path: Path, ref: str) -> bool:
+    rev_parse = ["git", "rev-parse", "--verify", "--quiet", f"{ref}^{{commit}}"]
+    return subprocess.run(rev_parse, cwd=path, capture_output=True).returncode == 0
+
+
+def _is_shallow(path: Path) -> bool:
+    rev_parse = ("rev-parse", "--is-shallow-repository")
+    error = f"Failed to read {path}"
+    return _git(*rev_parse, cwd=path, error=error).stdout.strip() == "true"
+
+
+def _deepen(path: Path, ref: str, error: str) -> None:
+    """Fetch more history into a shallow clone until it contains ref"""
+    deepen = 50
+    while _is_shallow(path) and not _has_commit(path, ref):
+        if deepen > 1000:
+            _git("fetch", "--quiet", "--unshallow", "origin", cwd=path, error=error)
+            return
+        fetch = ("fetch", "--quiet", f"--deepen={deepen}", "origin")
+        _git(*fetch, cwd=path, error=error)
+        deepen *= 2
+
+
+def checkout_version(app: str, version: str = None, depth: int = None) -> None:
+    """Checkout a specific version (tag or branch) of a submodule
+
+    Only the requested tag or branch is fetched. In a shallow clone, it is
+    fetched with depth commits of history and further history is fetched only
+    if the version is not a tag or branch, such as an older commit.
+
+    Parameters
+    ----------
+    app : str
+        The name of the app (submodule)
+    version : str, optional
+        The version (tag or branch) to checkout. If not provided,
+        stays on default branch.
+    depth : int, optional
+        The history to fetch with the version in a shallow clone. Defaults to
+        the version's commit alone.
+
+    Raises
+    ------
+    RuntimeError
+        If the version cannot be fetched or checked out
+    """
+    if not version:
+        return
+
+    app_path = Path("app", app)
+    error = f"Failed to checkout version '{version}' in {app}"
+    fetch = ["fetch", "--quiet", "origin"]
+    if _is_shallow(app_path):
+        fetch.append(f"--depth={depth or 1}")
+    refspecs = (
+        f"+refs/tags/{version}:refs/tags/{version}",
+        f"+refs/heads/{version}:refs/remotes/origin/{version}",
+    )
+    # Tags do not move, so one which is already here needs no fetch
+    if not _has_commit(app_path, f"refs/tags/{version}"):
+        for refspec in refspecs:
+            try:
+                _git(*fetch, refspec, cwd=app_path, error=error)
+                break
+            except RuntimeError:
+                continue
+        else:
+            _deepen(app_path, version, error)
+    _git("checkout", "--quiet", version, cwd=app_path, error=error)
+
+
+def _dependency_version(dependency: Dict) -> str:
+    version_info = dependency.get("version") or {}
+    return version_info.get("version_tag") or version_info.get("version_branch")
+
+
+def _submodule_urls(repo) -> Dict[str, str]:
+    import pygit2
+
+    gitmodules = Path(repo.workdir, ".gitmodules")
+    if not gitmodules.exists():
+        return {}
+    config = pygit2.Config(str(gitmodules))
+    return {
+        entry.value: config[entry.name[: -len(".path")] + ".url"]
+        for entry in config
+        if entry.name.startswith("submodule.") and entry.name.endswith(".path")
+    }
+
+
+def _submodule_clone_options(repo) -> Dict[str, Tuple[int, str]]:
+    """The depth and filter recorded in .gitmodules for each submodule path"""
+    import pygit2
+
+    gitmodules = Path(repo.workdir, ".gitmodules")
+    if not gitmodules.exists():
+        return {}
+    config = pygit2.Config(str(gitmodules))
+    options = {}
+    for entry in config:
+        if entry.name.startswith("submodule.") and entry.name.endswith(".path"):
+            prefix = entry.name[: -len(".path")]
+            depth = config[f"{prefix}.depth"] if f"{prefix}.depth" in config else None
+            filter = (
+                config[f"{prefix}.filter"] if f"{prefix}.filter" in config else None
+            )
+            options[entry.value] = (int(depth) if depth else None, filter)
+    return options
+
+
+def _clone_app(
+    url: str, path: Path, version: str = None, depth: int = None, filter: str = None
+):
+    import pygit2
+
+    try:
+        if not Path(path, ".git").exists():
+            _clone(url, path, depth, filter)
+        checkout_version(path.name, version, depth)
+        return pygit2.Repository(str(path)).head.target
+    except pygit2.GitError as e:
+        raise RuntimeError(f"Failed to clone {url} into {path}: {e}")
+
+
+def sync_apps(
+    urls: Dict[str, str] = None,
+    max_workers: int = SYNC_WORKERS,
+    depth: int = None,
+    filter: str = None,
+) -> Dict:
+    """Fetch the main app and all of its dependencies
+
+    The dependencies listed in the main app's anvil.yaml are cloned concurrently,
+    each is checked out at its pinned version_tag or version_branch and the
+    result is registered as submodules and dependencies in a single commit.
+
+    Parameters
+    ----------
+    urls
+        Clone URLs keyed by dependency id. Dependencies which are already
+        submodules of the project default to their existing URL.
+    max_workers
+        The maximum number of apps to fetch at the same time
+    depth
+        The number of commits of history to fetch for each app. Apps which are
+        already submodules default to the depth recorded in .gitmodules.
+    filter
+        A git object filter, such as blob:none, for partial clones. Apps which
+        are already submodules default to the filter recorded in .gitmodules.
+
+    Returns
+    -------
+    Dict
+        The checked out commit id for each app fetched from a repository, keyed
+        by app name. Apps which are plain folders of the project are left as
+        they are.
+
+    Raises
+    ------
+    RuntimeError
+        If an app is missing and has no known URL, or cannot be fetched
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    import pygit2
+
+    urls = urls or {}
+    repo = pygit2.Repository(".")
+    known_urls = _submodule_urls(repo)
+    known_options = _submodule_clone_options(repo)
+
+    def clone_options(path):
+        recorded = known_options.get(path.as_posix(), (None, None))
+        return depth or recorded[0], filter or recorded[1]
+
+    main_app = _get_main_app()
+    main_path = Path("app", main_app)
+    apps = {
+        main_app: (
+            known_urls.get(main_path.as_posix()),
+            main_path,
+            None,
+            *clone_options(main_path),
+        )
+    }
+    if not Path(main_path, "anvil.yaml").exists():
+        if apps[main_app][0] is None:
+            raise RuntimeError(f"No repository URL is known for {main_app}")
+        _clone_app(*apps[main_app])
+
+    dependencies = {}
+    missing = []
+    for dependency in _get_app_config(main_app).get("dependencies", []):
+        dep_id = dependency["dep_id"]
+        name = dependency["resolution_hints"]["package_name"]
+        path = Path("app", name)
+        url = urls.get(dep_id) or known_urls.get(path.as_posix())
+        # An app without a repository is used as it is, if it is there at all
+        if url is None and not path.exists():
+            missing.append(f"{name} ({dep_id})")
+        apps[name] = (url, path, _dependency_version(dependency), *clone_options(path))
+        dependencies[dep_id] = name
+    if missing:
+        raise RuntimeError(f"No repository URL given for {', '.join(missing)}")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            name: executor.submit(_clone_app, *app)
+            for name, app in apps.items()
+            if app[0] is not None
+        }
+        commits = {name: future.result() for name, future in futures.items()}
+
+    gitmodules = pygit2.Config(str(Path(repo.workdir, ".gitmodules")))
+    with Project(f"Sync {main_app} and {len(dependencies)} dependencies") as project:
+        for name, (url, path, _, app_depth, app_filter) in apps.items():
+            if url is None:
+                continue
+            submodule = path.as_posix()
+            gitmodules[f"submodule.{submodule}.path"] = submodule
+            gitmodules[f"submodule.{submodule}.url"] = url
+            _set_clone_options(gitmodules, submodule, app_depth, app_filter)
+            repo.config[f"submodule.{submodule}.url"] = url
+            project.stage(path)
+        project.stage(".gitmodules")
+        for dep_id, name in dependencies.items():
+            project.set_dependency(dep_id, name)
+    if commits:
+        _absorb_git_dirs(apps[name][1].as_posix() for name in commits)
+    return {name: str(commit) for name, commit in commits.items()}
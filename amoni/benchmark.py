@@ -0,0 +1,249 @@
+# SPDX-License-Identifier: MIT
+#
+# Copyright (c) 2021 The Amoni project team members listed at
+# https://github.com/anvilistas/amoni/graphs/contributors
+#
+# This software is published at https://github.com/anvilistas/amoni
+"""A small HTTP/1.1 load generator for benchmarking the local app server
+
+Each client is an asyncio task keeping one connection open, so that a single
+process can keep many requests in flight without threads.
+"""
+
+import os
+import time
+from typing import Dict, Iterable, List, Tuple
+
+from .api import get_ports
+
+__version__ = "0.0.13"
+
+BENCH_CONCURRENCY = int(os.environ.get("AMONI_BENCH_CONCURRENCY", "10"))
+BENCH_DURATION = float(os.environ.get("AMONI_BENCH_DURATION", "10"))
+BENCH_TOLERANCE = float(os.environ.get("AMONI_BENCH_TOLERANCE", "0.1"))
+# Seconds to wait for a connection or a response before counting an error
+BENCH_TIMEOUT = float(os.environ.get("AMONI_BENCH_TIMEOUT", "10"))
+
+
+async def _read_response(reader, head: bool = False) -> Tuple[int, bool]:
+    """Read an HTTP response, returning its status and whether to keep alive"""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("The server closed the connection")
+    version, status = status_line.decode("latin-1").split()[:2]
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    if status[0] == "1" and status != "101":
+        # An interim response, such as 100 Continue, precedes the final one
+        return await _read_response(reader, head)
+    keep_alive = headers.get("connection", "").lower() != "close" and (
+        version != "HTTP/1.0" or headers.get("connection", "").lower() == "keep-alive"
+    )
+    if head:
+        pass
+    elif headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    elif "content-length" in headers:
+        await reader.readexactly(int(headers["content-length"]))
+    elif status[0] != "1" and status not in ("204", "304"):
+        await reader.read()
+        keep_alive = False
+    return int(status), keep_alive
+
+
+async def _bench_worker(
+    url, requests: List[bytes], deadline, results, head=False, timeout=BENCH_TIMEOUT
+):
+    """Send requests over one connection, reconnecting when it is closed"""
+    import asyncio
+    import socket
+    import ssl
+
+    port = url.port or (443 if url.scheme == "https" else 80)
+    context = ssl.create_default_context() if url.scheme == "https" else None
+    writer = None
+    index = 0
+    while time.perf_counter() < deadline:
+        request = requests[index % len(requests)]
+        index += 1
+        started = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(url.hostname, port, ssl=context),
+                    timeout,
+                )
+                sock = writer.get_extra_info("socket")
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            writer.write(request)
+            status, keep_alive = await asyncio.wait_for(
+                _read_response(reader, head), timeout
+            )
+        except (
+            OSError,
+            ValueError,
+            asyncio.IncompleteReadError,
+            asyncio.TimeoutError,
+        ) as e:
+            results["errors"].append(type(e).__name__)
+            if writer is not None:
+                writer.close()
+                writer = None
+            # Avoid spinning while the server is refusing connections
+            await asyncio.sleep(0.05)
+            continue
+        results["latencies"].append(time.perf_counter() - started)
+        results["statuses"][status] = results["statuses"].get(status, 0) + 1
+        if not keep_alive:
+            writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+
+def _percentile(ordered: List[float], fraction: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def run_benchmark(
+    paths: Iterable[str] = ("/",),
+    concurrency: int = BENCH_CONCURRENCY,
+    duration: float = BENCH_DURATION,
+    method: str = "GET",
+    body: str = None,
+    url: str = None,
+) -> Dict:
+    """Send HTTP requests to the local app for a while and measure them
+
+    Each of the concurrent clients keeps a connection open and sends the next
+    request as soon as it has the previous response, cycling through the paths.
+    A connection or response taking longer than AMONI_BENCH_TIMEOUT seconds
+    counts as an error.
+    Server functions can be benchmarked through their HTTP endpoints, whose
+    paths start with /_/api.
+
+    Parameters
+    ----------
+    paths
+        The paths to request
+    concurrency
+        The number of clients sending requests at once
+    duration
+        The number of seconds to send requests for
+    method
+        The HTTP method of each request
+    body
+        The body of each request
+    url
+        The url of the app. Defaults to the origin url of the project.
+
+    Returns
+    -------
+    Dict
+        The requests made, errors, throughput in requests per second, latency
+        percentiles in milliseconds and count of each response status
+
+    Raises
+    ------
+    RuntimeError
+        If no request receives a response
+    """
+    import asyncio
+    from urllib.parse import urlsplit
+
+    base = urlsplit(url or get_ports()[2])
+    host = base.netloc.rpartition("@")[2]
+    content = body.encode() if body is not None else b""
+    headers = f"Host: {host}\r\nUser-Agent: amoni-bench\r\nAccept: */*\r\n"
+    if body is not None or method in ("POST", "PUT", "PATCH"):
+        headers += f"Content-Length: {len(content)}\r\n"
+    prefix = base.path.rstrip("/")
+    requests = [
+        f"{method} {prefix}{path} HTTP/1.1\r\n{headers}\r\n".encode() + content
+        for path in paths
+    ]
+    results = {"latencies": [], "errors": [], "statuses": {}}
+    head = method == "HEAD"
+
+    async def bench():
+        deadline = time.perf_counter() + duration
+        workers = [
+            _bench_worker(base, requests[i:] + requests[:i], deadline, results, head)
+            for i in range(concurrency)
+        ]
+        await asyncio.gather(*workers)
+
+    started = time.perf_counter()
+    asyncio.run(bench())
+    elapsed = time.perf_counter() - started
+    latencies = sorted(results["latencies"])
+    if not latencies:
+        errors = ", ".join(sorted(set(results["errors"])))
+        raise RuntimeError(f"No responses from {base.geturl()}: {errors}")
+    failed = sum(n for status, n in results["statuses"].items() if status >= 500)
+    return {
+        "url": base.geturl(),
+        "paths": list(paths),
+        "method": method,
+        "concurrency": concurrency,
+        "duration": elapsed,
+        "requests": len(latencies),
+        "errors": len(results["errors"]) + failed,
+        "throughput": len(latencies) / elapsed,
+        "latency_ms": {
+            "mean": 1000 * sum(latencies) / len(latencies),
+            "p50": 1000 * _percentile(latencies, 0.5),
+            "p95": 1000 * _percentile(latencies, 0.95),
+            "p99": 1000 * _percentile(latencies, 0.99),
+            "max": 1000 * latencies[-1],
+        },
+        "statuses": {str(k): v for k, v in sorted(results["statuses"].items())},
+    }
+
+
+def compare_benchmark(
+    result: Dict, baseline: Dict, tolerance: float = BENCH_TOLERANCE
+) -> List[str]:
+    """The ways in which a benchmark result is worse than a baseline
+
+    Parameters
+    ----------
+    result
+        A result from :func:`run_benchmark`
+    baseline
+        An earlier result to compare against
+    tolerance
+        The fraction by which throughput may fall, or latency rise, before it
+        counts as a regression
+
+    Returns
+    -------
+    List[str]
+        A description of each regression
+    """
+    regressions = []
+    if result["throughput"] < baseline["throughput"] * (1 - tolerance):
+        regressions.append(
+            f"Throughput fell from {baseline['throughput']:.1f} to "
+            f"{result['throughput']:.1f} requests/s"
+        )
+    for key in ("p50", "p95", "p99"):
+        before, after = baseline["latency_ms"][key], result["latency_ms"][key]
+        if after > before * (1 + tolerance):
+            regressions.append(f"{key} latency rose from {before:.1f} to {after:.1f}ms")
+    before = baseline["errors"] / max(baseline["requests"], 1)
+    after = result["errors"] / max(result["requests"], 1)
+    if after > before:
+        regressions.append(f"Error rate rose from {before:.2%} to {after:.2%}")
+    return regressions
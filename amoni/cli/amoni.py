@@ -5,21 +5,22 @@
 #
 # This software is published at https://github.com/anvilistas/amoni
 import os
-import time
 from pathlib import Path
+from typing import List
 
 import typer
-from cookiecutter.exceptions import OutputDirExistsException
-from dotenv import load_dotenv, set_key
 
-from .. import api
-from . import app, echo, theme
+from .. import api, benchmark, database, selection
+from . import app, db, echo, server, table, theme
 
 __version__ = "0.0.13"
 
 cmd = typer.Typer()
 cmd.add_typer(app.cmd, name="app", help="Manage anvils apps and dependencies")
 cmd.add_typer(theme.cmd, name="theme", help="Build the theme.css for an app")
+cmd.add_typer(db.cmd, name="db", help="Manage the local app database")
+cmd.add_typer(table.cmd, name="table", help="Manage the data tables of an app")
+cmd.add_typer(server.cmd, name="server", help="Configure the app server")
 
 
 @cmd.callback()
@@ -39,10 +40,18 @@ def init(
         "-i",
         help="Use interactive setup mode that guides you through configuration",
     ),
+    refresh_template: bool = typer.Option(
+        False, help="Fetch the latest project template instead of the cached one"
+    ),
+    offline: bool = typer.Option(
+        False, help="Use the cached project template without network access"
+    ),
 ):
     """Create the amoni folder structure and initialise a git repo there"""
+    from cookiecutter.exceptions import OutputDirExistsException
+
     try:
-        api.init(directory, app)
+        api.init(directory, app, refresh_template=refresh_template, offline=offline)
         echo.progress(f"Amoni project created in {directory}")
 
         if interactive:
@@ -51,35 +60,41 @@ def init(
         echo.done()
     except OutputDirExistsException:
         echo.error(f"Error creating project. {directory} already exists")
+    except RuntimeError as e:
+        echo.error(str(e))
+        raise typer.Exit(1)
 
 
 @cmd.command()
 def start(
     update: bool = typer.Option(False, help="Whether to update the docker images"),
     launch: bool = typer.Option(True, help="Whether to launch the app"),
+    timeout: float = typer.Option(
+        api.READY_TIMEOUT, help="Seconds to wait for the servers to be ready"
+    ),
 ):
     """Start the anvil app and db servers"""
-    if update:
-        typer.echo("Rebuilding server images")
-        api.build_image("app")
-        api.pull_image("db")
     try:
+        if update:
+            _refresh_images(build=("app",), pull=("db",))
+        else:
+            _check_images()
         current_app_port, current_db_port, origin_url, env_file_found = api.get_ports()
         if not env_file_found:
             echo.warn(
                 "No .env file found. Falling back to default values for app url and ports"
             )
 
-        with echo.working("Starting anvil app and database servers"):
-            api.start_service("app", detach=True)
+        if not update and api.services_are_current():
+            echo.progress("The app and database servers are already running")
+        else:
+            _start_services(timeout)
 
         echo.progress(f"Your app is available at {origin_url}!")
         echo.progress(
             f"PostgreSQL database is available at localhost:{current_db_port}!"
         )
         if launch:
-            echo.progress("Waiting for services to be ready...")
-            time.sleep(2)
             try:
                 typer.launch(origin_url)
             except Exception:
@@ -93,6 +108,76 @@ def start(
         raise typer.Exit(1)
 
 
+def _refresh_images(build=(), pull=()):
+    """Build and pull images at the same time, labelling each line of output"""
+    import threading
+
+    lock = threading.Lock()
+
+    def output(service, line):
+        with lock:
+            typer.echo(f"[{service}] {line}")
+
+    echo.progress("Updating server images")
+    timings = api.refresh_images(build=build, pull=pull, output=output)
+    echo.progress(
+        ", ".join(f"{service} {seconds:.1f}s" for service, seconds in timings.items())
+    )
+
+
+def _check_images():
+    """Warn of newer images found earlier and look for them again if it is time"""
+    newer = api.newer_images()
+    if newer:
+        echo.warn(
+            f"Newer images are available for {', '.join(newer)}. "
+            "Run with --update to use them"
+        )
+    api.check_for_newer_images_in_background()
+
+
+def _start_services(timeout: float):
+    database.refresh_db_config()
+    with echo.working("Starting anvil app and database servers"):
+        api.start_service("app", detach=True)
+
+    with echo.working("Waiting for services to be ready"):
+        timings = api.wait_for_services(timeout=timeout)
+    echo.progress(
+        f"App server ready in {timings['app']:.1f}s, "
+        f"database ready in {timings['db']:.1f}s"
+    )
+
+    def not_created(name, error):
+        echo.warn(f"Index {name} was not created: {error}")
+
+    created = database.apply_indexes(on_error=not_created)
+    if created:
+        echo.progress(f"Created {len(created)} data table indexes")
+
+
+@cmd.command()
+def logs(
+    service: str = typer.Argument("app", help="Name of the service"),
+    follow: bool = typer.Option(False, "--follow", "-f", help="Keep showing new logs"),
+    tail: str = typer.Option("all", help="Number of lines to show from the end"),
+):
+    """Show the logs of a service"""
+    import sys
+
+    def output(data):
+        sys.stdout.buffer.write(data)
+        sys.stdout.flush()
+
+    try:
+        api.stream_logs(service, output, follow=follow, tail=tail)
+    except RuntimeError as e:
+        echo.error(str(e))
+        raise typer.Exit(1)
+    except KeyboardInterrupt:
+        pass
+
+
 @cmd.command()
 def stop():
     """Stop the anvil app and db servers"""
@@ -104,13 +189,94 @@ def stop():
 @cmd.command()
 def test(
     update: bool = typer.Option(False, help="Whether to update the docker image"),
+    wait: bool = typer.Option(
+        False, help="Whether to wait for the app and db servers to be ready"
+    ),
+    timeout: float = typer.Option(
+        api.READY_TIMEOUT, help="Seconds to wait for the servers to be ready"
+    ),
+    shards: int = typer.Option(
+        1, help="Number of test runner containers to split the tests across"
+    ),
+    junitxml: Path = typer.Option(
+        None, dir_okay=False, help="Where to write the merged junit report"
+    ),
+    reuse: bool = typer.Option(
+        False, help="Run the tests in a test runner container which stays running"
+    ),
+    watch: bool = typer.Option(
+        False, help="Re-run the affected tests whenever files change"
+    ),
+    stop_runner: bool = typer.Option(
+        False, help="Stop the test runner container kept running by --reuse"
+    ),
+    changed: bool = typer.Option(
+        False, help="Run only the tests affected by changes since the last green run"
+    ),
 ):
     """Run the test suite"""
-    echo.progress("Checking for newer images")
     service = "test_runner"
-    if update:
-        api.build_image(service)
-    api.run_service(service)
+    status = 0
+    try:
+        if stop_runner:
+            api.stop_test_runner()
+            echo.done()
+            return
+        if update:
+            _refresh_images(build=(service,))
+        else:
+            _check_images()
+        if wait:
+            with echo.working("Waiting for services to be ready"):
+                api.wait_for_services(timeout=timeout)
+        tests = None
+        if changed:
+            changed_paths = selection.changed_since_green()
+            if changed_paths is not None:
+                tests = selection.select_tests(changed_paths)
+            if tests == []:
+                echo.progress("No tests are affected by the changes since they passed")
+                echo.done()
+                return
+        pytest_args = tests or []
+
+        if watch:
+            _report_test_run([], api.run_tests_in_runner())
+            echo.progress("Watching for changes. Press Ctrl+C to stop")
+            try:
+                api.watch_tests(_report_test_run)
+            except KeyboardInterrupt:
+                pass
+        elif reuse:
+            status = api.run_tests_in_runner(pytest_args)
+        elif shards > 1:
+            result = api.run_tests_sharded(
+                shards, junitxml, output=typer.echo, files=tests
+            )
+            echo.progress(
+                f"{result['tests']} tests, {result['failures']} failures, "
+                f"{result['errors']} errors, {result['skipped']} skipped "
+                f"in {result['time']:.1f}s"
+            )
+            status = result["status"]
+        else:
+            command = ["pytest", *pytest_args] if pytest_args else []
+            api.run_service(service, command=command)
+        if not (status or watch):
+            selection.record_green()
+    except RuntimeError as e:
+        echo.error(str(e))
+        raise typer.Exit(1)
+    if status:
+        raise typer.Exit(status)
+
+
+def _report_test_run(args, status):
+    tests = " ".join(args) or "all tests"
+    if status:
+        echo.error(f"Failed: {tests}")
+    else:
+        echo.progress(f"Passed: {tests}")
 
 
 def _interactive_setup(directory: Path):
@@ -130,13 +296,17 @@ def _interactive_setup(directory: Path):
     app_config = api._get_app_config(repo_name)
     deps = app_config.get("dependencies", [])
 
+    urls = {}
     for dep in deps:
         dep_id = dep["dep_id"]
         package_name = dep["resolution_hints"]["package_name"]
-        dep_url = typer.prompt(
+        urls[dep_id] = typer.prompt(
             f"Enter repository URL for dependency {package_name} ({dep_id})"
         )
-        app.add(dep_url, package_name, id=dep_id, as_dependency=True, set_version=True)
+    if deps:
+        with echo.working(f"Fetching {len(deps)} dependencies"):
+            api.sync_apps(urls)
+        echo.progress(f"Added {len(deps)} dependencies")
 
     app_port = typer.prompt("Enter port number for the app server", default="3030")
     db_port = typer.prompt("Enter port number for the database", default="5432")
@@ -144,6 +314,8 @@ def _interactive_setup(directory: Path):
         "Enter origin URL", default=f"http://localhost:{app_port}"
     )
 
+    from dotenv import load_dotenv, set_key
+
     env_path = Path(directory, ".env")
     load_dotenv(env_path)
 
@@ -151,14 +323,106 @@ def _interactive_setup(directory: Path):
     set_key(env_path, "AMONI_DB_PORT", db_port)
     set_key(env_path, "ORIGIN_URL", origin_url)
 
-    api._commit_all("Update project configuration")
+    api._commit("Update project configuration", [env_path])
 
     echo.progress("Interactive setup completed successfully")
 
 
 @cmd.command()
-def stubs(app: str = typer.Argument(..., help="App folder name")):
+def stubs(
+    app: str = typer.Argument(None, help="App folder name"),
+    all_apps: bool = typer.Option(
+        False, "--all", help="Generate stubs for the main app and its dependencies"
+    ),
+):
     """Generate stubs for the database"""
-    api.generate_table_stubs(app)
-    echo.progress(f"Created table definitions in {api.TABLE_STUB_FILE}")
+    if not (app or all_apps):
+        raise typer.BadParameter("Specify an app or use --all")
+    if all_apps:
+        written = api.generate_all_table_stubs()
+    else:
+        written = {app: api.TABLE_STUB_FILE} if api.generate_table_stubs(app) else {}
+    for target in written.values():
+        echo.progress(f"Created table definitions in {target}")
+    if not written:
+        echo.progress("Table definitions are up to date")
+    echo.done()
+
+
+@cmd.command()
+def watch(
+    debounce: float = typer.Option(
+        api.WATCH_DEBOUNCE, help="Seconds to wait for further changes before running"
+    ),
+):
+    """Regenerate table stubs and themes when their sources change"""
+
+    def report(kind, app, result):
+        if isinstance(result, Exception):
+            echo.error(f"Failed to update {kind} for {app}: {result}")
+        elif kind == "stubs" and result:
+            echo.progress(f"Updated table definitions for {app}")
+        elif kind == "theme" and result:
+            echo.progress(f"Created theme.css in app/{app}/theme/assets")
+
+    echo.progress("Watching for changes in the app folder. Press Ctrl+C to stop")
+    try:
+        api.watch(report, debounce=debounce)
+    except KeyboardInterrupt:
+        pass
+    echo.done()
+
+
+@cmd.command()
+def bench(
+    path: List[str] = typer.Option(["/"], help="Path to request. Can be repeated"),
+    concurrency: int = typer.Option(
+        benchmark.BENCH_CONCURRENCY, help="Number of clients sending requests at once"
+    ),
+    duration: float = typer.Option(
+        benchmark.BENCH_DURATION, help="Seconds to send requests for"
+    ),
+    method: str = typer.Option("GET", help="HTTP method of each request"),
+    data: str = typer.Option(None, help="Body of each request"),
+    url: str = typer.Option(None, help="Url of the app. Defaults to ORIGIN_URL"),
+    output: Path = typer.Option(None, dir_okay=False, help="Where to save the results"),
+    baseline: Path = typer.Option(
+        None, exists=True, dir_okay=False, help="Earlier results to compare against"
+    ),
+    tolerance: float = typer.Option(
+        benchmark.BENCH_TOLERANCE, help="Fraction by which results may worsen"
+    ),
+):
+    """Put load on the local app and report its throughput and latency"""
+    import json
+
+    try:
+        with echo.working(f"Sending requests for {duration:g}s"):
+            result = benchmark.run_benchmark(
+                path, concurrency, duration, method.upper(), data, url
+            )
+    except RuntimeError as e:
+        echo.error(str(e))
+        raise typer.Exit(1)
+    latency = result["latency_ms"]
+    echo.progress(
+        f"{result['requests']} requests, {result['errors']} errors, "
+        f"{result['throughput']:.1f} requests/s"
+    )
+    echo.progress(
+        f"Latency p50 {latency['p50']:.1f}ms, p95 {latency['p95']:.1f}ms, "
+        f"p99 {latency['p99']:.1f}ms, max {latency['max']:.1f}ms"
+    )
+    if output:
+        output.write_text(json.dumps(result, indent=2))
+        echo.progress(f"Saved results to {output}")
+    if baseline:
+        regressions = benchmark.compare_benchmark(
+            result, json.loads(baseline.read_text()), tolerance
+        )
+        for regression in regressions:
+            echo.error(regression)
+        if regressions:
+            raise typer.Exit(1)
+        echo.progress(f"No regressions compared to {baseline}")
     echo.done()
@@ -5,6 +5,7 @@
 #
 # This software is published at https://github.com/anvilistas/amoni
 from pathlib import Path
+from typing import List
 
 import typer
 
@@ -30,6 +31,12 @@ def add(
         False,
         help="Whether to set version from main app's anvil.yaml",
     ),
+    depth: int = typer.Option(
+        None, min=1, help="Number of commits of history to fetch"
+    ),
+    filter: str = typer.Option(
+        None, help="Objects to fetch only when needed, such as blob:none"
+    ),
 ):
     """Fetch an anvil app and set it as the app to run"""
     if as_dependency and not id:
@@ -37,15 +44,14 @@ def add(
             "You must specify the app id to add it as a dependency"
         )
     try:
-        api.add_submodule(url, Path("app", name), name)
+        api.add_submodule(url, Path("app", name), name, depth=depth, filter=filter)
         echo.progress(f"Added {name} as a submodule in the app directory")
 
         if as_dependency:
             api.set_dependency(id, name)
 
         if set_version:
-            anvil_config = api.load(api.ANVIL_CONFIG_FILE.open(), Loader=api.Loader)
-            main_app = Path(anvil_config["app"]).name
+            main_app = api._get_main_app()
             echo.progress(f"Main app: {main_app}")
 
             app_config = api._get_app_config(main_app)
@@ -55,13 +61,10 @@ def add(
             for dep in deps:
                 echo.progress(f"Checking dep {dep['dep_id']}")
                 if dep["dep_id"] == id:
-                    version_info = dep.get("version", {})
-                    version = version_info.get("version_tag") or version_info.get(
-                        "version_branch"
-                    )
-                    echo.progress(f"Found version info: {version_info}")
+                    version = api._dependency_version(dep)
+                    echo.progress(f"Found version info: {dep.get('version', {})}")
                     if version:
-                        api.checkout_version(name, version)
+                        api.checkout_version(name, version, depth)
                         echo.progress(f"Checked out version {version} for {name}")
                     break
         else:
@@ -74,3 +77,36 @@ def add(
     except RuntimeError as e:
         echo.error(str(e))
         raise typer.Exit(1)
+
+
+@cmd.command()
+def sync(
+    url: List[str] = typer.Option(
+        [], help="Clone URL for a dependency in the form DEP_ID=URL"
+    ),
+    workers: int = typer.Option(
+        api.SYNC_WORKERS, help="Maximum number of apps to fetch at the same time"
+    ),
+    depth: int = typer.Option(
+        None, min=1, help="Number of commits of history to fetch for each app"
+    ),
+    filter: str = typer.Option(
+        None, help="Objects to fetch only when needed, such as blob:none"
+    ),
+):
+    """Fetch the main app and all its dependencies at their pinned versions"""
+    try:
+        urls = dict(u.split("=", 1) for u in url)
+    except ValueError:
+        raise typer.BadParameter("URLs must be given in the form DEP_ID=URL")
+    try:
+        with echo.working("Fetching apps"):
+            commits = api.sync_apps(
+                urls, max_workers=workers, depth=depth, filter=filter
+            )
+        for name, commit in commits.items():
+            echo.progress(f"{name} is at {commit[:7]}")
+        echo.done()
+    except RuntimeError as e:
+        echo.error(str(e))
+        raise typer.Exit(1)
@@ -0,0 +1,142 @@
+# SPDX-License-Identifier: MIT
+#
+# Copyright (c) 2021 The Amoni project team members listed at
+# https://github.com/anvilistas/amoni/graphs/contributors
+#
+# This software is published at https://github.com/anvilistas/amoni
+import shutil
+
+import typer
+
+from .. import database
+from . import echo
+
+__version__ = "0.0.13"
+
+
+cmd = typer.Typer()
+
+
+@cmd.command()
+def snapshot(name: str = typer.Argument(..., help="Name of the snapshot")):
+    """Save a snapshot of the app database"""
+    try:
+        with echo.working(f"Saving snapshot {name}"):
+            seconds = database.snapshot_database(name)
+        echo.progress(f"Saved snapshot {name} in {seconds:.2f}s")
+        echo.done()
+    except RuntimeError as e:
+        echo.error(str(e))
+        raise typer.Exit(1)
+
+
+@cmd.command()
+def restore(name: str = typer.Argument(..., help="Name of the snapshot")):
+    """Restore the app database from a snapshot"""
+    try:
+        with echo.working(f"Restoring snapshot {name}"):
+            seconds = database.restore_database(name)
+        echo.progress(f"Restored snapshot {name} in {seconds:.2f}s")
+        echo.done()
+    except RuntimeError as e:
+        echo.error(str(e))
+        raise typer.Exit(1)
+
+
+@cmd.command("list")
+def list_():
+    """List the snapshots of the app database"""
+    try:
+        for name in database.list_snapshots():
+            typer.echo(name)
+    except RuntimeError as e:
+        echo.error(str(e))
+        raise typer.Exit(1)
+
+
+@cmd.command()
+def delete(name: str = typer.Argument(..., help="Name of the snapshot")):
+    """Delete a snapshot of the app database"""
+    try:
+        database.delete_snapshot(name)
+        echo.progress(f"Deleted snapshot {name}")
+        echo.done()
+    except RuntimeError as e:
+        echo.error(str(e))
+        raise typer.Exit(1)
+
+
+@cmd.command()
+def profile(
+    explain_ms: float = typer.Option(
+        None, help="Log the plans of queries taking longer than this many ms"
+    ),
+    off: bool = typer.Option(False, "--off", help="Stop recording query statistics"),
+):
+    """Record statistics on the queries run in the app database"""
+    try:
+        if off:
+            with echo.working("Disabling query statistics"):
+                database.disable_query_stats()
+        else:
+            with echo.working("Enabling query statistics"):
+                database.enable_query_stats(explain_after=explain_ms)
+            echo.progress("Run 'amoni db top' to see the slowest queries")
+        echo.done()
+    except RuntimeError as e:
+        echo.error(str(e))
+        raise typer.Exit(1)
+
+
+@cmd.command()
+def top(
+    limit: int = typer.Option(10, help="Number of queries to show"),
+    order: str = typer.Option("time", help="Order by total time, mean time or calls"),
+):
+    """Show the queries which have taken the most time"""
+    try:
+        stats = database.query_stats(limit=limit, order=order)
+    except RuntimeError as e:
+        echo.error(str(e))
+        raise typer.Exit(1)
+    width = shutil.get_terminal_size().columns
+    typer.echo(f"{'calls':>8} {'total ms':>10} {'mean ms':>9} {'rows':>8}  query")
+    for stat in stats:
+        tables = f"[{', '.join(stat['tables'])}] " if stat["tables"] else ""
+        line = (
+            f"{stat['calls']:>8} {stat['total_ms']:>10.1f} {stat['mean_ms']:>9.2f} "
+            f"{stat['rows']:>8}  {tables}{stat['query']}"
+        )
+        typer.echo(line[:width])
+
+
+@cmd.command()
+def reset_stats():
+    """Discard the query statistics recorded so far"""
+    try:
+        database.reset_query_stats()
+        echo.progress("Reset query statistics")
+        echo.done()
+    except RuntimeError as e:
+        echo.error(str(e))
+        raise typer.Exit(1)
+
+
+@cmd.command()
+def tune(
+    profile: str = typer.Option(
+        "tuned", help="stock, tuned or fast, which turns off crash safety"
+    ),
+):
+    """Run the database with settings sized to this machine"""
+    try:
+        with echo.working(f"Restarting the database with the {profile} profile"):
+            settings = database.tune_database(profile)
+        for key, value in settings.items():
+            typer.echo(f"{key} = {value}")
+        if profile == "fast":
+            echo.warn("Data may be lost if the database container stops abruptly")
+        echo.done()
+    except RuntimeError as e:
+        echo.error(str(e))
+        raise typer.Exit(1)
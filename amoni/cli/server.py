@@ -0,0 +1,41 @@
+# SPDX-License-Identifier: MIT
+#
+# Copyright (c) 2021 The Amoni project team members listed at
+# https://github.com/anvilistas/amoni/graphs/contributors
+#
+# This software is published at https://github.com/anvilistas/amoni
+import typer
+
+from .. import api
+from . import echo
+
+__version__ = "0.0.13"
+
+
+cmd = typer.Typer()
+
+
+@cmd.command()
+def tune(
+    preset: str = typer.Argument("dev", help="dev or load-test"),
+    heap_mb: int = typer.Option(None, help="JVM heap in MB"),
+    workers: int = typer.Option(None, help="Server calls expected to run at once"),
+    worker_memory_mb: int = typer.Option(None, help="Memory limit of each worker"),
+    worker_timeout: int = typer.Option(None, help="Seconds a server call may run"),
+):
+    """Set the memory and worker limits of the app server"""
+    try:
+        settings = api.tune_server(
+            preset,
+            heap_mb=heap_mb,
+            workers=workers,
+            worker_memory_mb=worker_memory_mb,
+            worker_timeout=worker_timeout,
+        )
+        for key, value in settings.items():
+            typer.echo(f"{key} = {value}")
+        echo.progress("Run 'amoni start' to restart the app server with them")
+        echo.done()
+    except RuntimeError as e:
+        echo.error(str(e))
+        raise typer.Exit(1)
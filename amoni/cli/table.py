@@ -4,9 +4,11 @@
 # https://github.com/anvilistas/amoni/graphs/contributors
 #
 # This software is published at https://github.com/anvilistas/amoni
+from pathlib import Path
+
 import typer
 
-from .. import api
+from .. import api, database
 from . import echo
 
 __version__ = "0.0.13"
@@ -23,7 +25,9 @@ def create(
     server: str = typer.Option("full", help="Server permissions for the table"),
 ):
     """Add a new data table to an app"""
-    api.add_table(app=app, name=table, client=client, server=server)
+    api.add_table(
+        app=app, name=table, client_permissions=client, server_permissions=server
+    )
     echo.progress(f"Added data table {table} to {app}")
     echo.done()
 
@@ -40,3 +44,72 @@ def add_column(
     api.add_column(app=app, table=table, name=name, data_type=data_type, target=target)
     echo.progress(f"Added {name} column to {table}")
     echo.done()
+
+
+@cmd.command()
+def load(
+    app: str = typer.Argument(..., help="Name of the anvil app"),
+    table: str = typer.Argument(..., help="Name of the table to load into"),
+    path: Path = typer.Argument(
+        ..., exists=True, dir_okay=False, help="A .csv or .jsonl file of rows"
+    ),
+):
+    """Load the rows of a csv or jsonl file into a data table"""
+
+    def report(rows):
+        echo.progress(f"Sent {rows} rows")
+
+    try:
+        rows, seconds = database.load_table(app, table, path, progress=report)
+        rate = rows / seconds if seconds else rows
+        summary = f"{rows} rows in {seconds:.2f}s ({rate:.0f} rows/s)"
+        echo.progress(f"Loaded {summary} into {table}")
+        echo.done()
+    except RuntimeError as e:
+        echo.error(str(e))
+        raise typer.Exit(1)
+
+
+@cmd.command()
+def index(
+    app: str = typer.Argument(..., help="Name of the anvil app"),
+    table: str = typer.Argument(..., help="Name of the table"),
+    column: str = typer.Argument(..., help="Name of the column to index"),
+):
+    """Index a column of a data table in the local database"""
+    try:
+        with echo.working(f"Indexing {column} column of {table}"):
+            name = database.create_index(app, table, column)
+        echo.progress(f"Created index {name}")
+        echo.done()
+    except RuntimeError as e:
+        echo.error(str(e))
+        raise typer.Exit(1)
+
+
+@cmd.command()
+def indexes():
+    """List the indexes recorded in the project"""
+    try:
+        for app, table, column, exists in database.list_indexes():
+            status = "" if exists else " (missing from the database)"
+            typer.echo(f"{app} {table} {column}{status}")
+    except RuntimeError as e:
+        echo.error(str(e))
+        raise typer.Exit(1)
+
+
+@cmd.command()
+def drop_index(
+    app: str = typer.Argument(..., help="Name of the anvil app"),
+    table: str = typer.Argument(..., help="Name of the table"),
+    column: str = typer.Argument(..., help="Name of the indexed column"),
+):
+    """Drop the index on a column of a data table"""
+    try:
+        database.drop_index(app, table, column)
+        echo.progress(f"Dropped index on {column} column of {table}")
+        echo.done()
+    except RuntimeError as e:
+        echo.error(str(e))
+        raise typer.Exit(1)
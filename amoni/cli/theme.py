@@ -21,11 +21,24 @@ cmd = typer.Typer()
 
 
 @cmd.command()
-def build(app: str = typer.Argument(..., help="App folder name")):
+def build(
+    app: str = typer.Argument(None, help="App folder name"),
+    all_apps: bool = typer.Option(False, "--all", help="Build the themes of all apps"),
+    force: bool = typer.Option(False, help="Build even if the theme is unchanged"),
+):
     """Build the theme for the app"""
+    if not (app or all_apps):
+        raise typer.BadParameter("Specify an app or use --all")
     try:
-        api.build_theme(app)
-        echo.progress(f"Created theme.css in app/{app}/theme/assets")
+        if all_apps:
+            built = api.build_themes(force=force)
+        else:
+            built = {app: api.build_theme(app, force=force)}
+        for name, was_built in built.items():
+            if was_built:
+                echo.progress(f"Created theme.css in app/{name}/theme/assets")
+            else:
+                echo.progress(f"Theme for {name} is up to date")
         echo.done()
     except RuntimeError as e:
         echo.error(str(e))
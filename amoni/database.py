@@ -0,0 +1,850 @@
+# SPDX-License-Identifier: MIT
+#
+# Copyright (c) 2021 The Amoni project team members listed at
+# https://github.com/anvilistas/amoni/graphs/contributors
+#
+# This software is published at https://github.com/anvilistas/amoni
+"""Tools for the local postgres database of the db service
+
+SQL runs through psql within the db container, so that nothing beyond docker is
+needed on the host.
+"""
+
+import json
+import os
+import subprocess
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+from .api import (
+    DB_CONFIG_VOLUME,
+    DB_INDEX_FILE,
+    DB_SERVICE,
+    Project,
+    _compose,
+    _compose_config,
+    _compose_override_file,
+    _docker_resources,
+    _engine,
+    _get_app_config,
+    _load_yaml,
+    _service_container,
+    _write_if_changed,
+    compose_command,
+    wait_for_services,
+)
+
+__version__ = "0.0.13"
+
+SNAPSHOT_PREFIX = "amoni_snapshot_"
+LOAD_CHUNK_ROWS = int(os.environ.get("AMONI_LOAD_CHUNK_ROWS", "10000"))
+INDEX_METHODS = {
+    "string": "btree",
+    "number": "btree",
+    "bool": "btree",
+    "date": "btree",
+    "datetime": "btree",
+    "link_single": "btree",
+    "simpleObject": "gin",
+    "link_multiple": "gin",
+}
+QUERY_STATS_SETTINGS = (
+    "shared_preload_libraries",
+    "pg_stat_statements.track",
+    "auto_explain.log_min_duration",
+)
+QUERY_STATS_ORDER = {
+    "time": "total_ms",
+    "mean": "mean_ms",
+    "calls": "calls",
+}
+DB_CONFIG_DIR = Path("db")
+DB_CONFIG_HEADER = "# Written by amoni for this machine. Changes will be overwritten.\n"
+DB_PROFILES = ("stock", "tuned", "fast")
+DB_MAX_CONNECTIONS = 100
+
+
+def _db_settings() -> Tuple[str, str]:
+    """The superuser and database name of the db service"""
+    service = _compose_config()["services"][DB_SERVICE]
+    environment = service.get("environment") or {}
+    if isinstance(environment, list):
+        environment = dict(e.split("=", 1) for e in environment if "=" in e)
+    user = environment.get("POSTGRES_USER") or "postgres"
+    return user, environment.get("POSTGRES_DB") or user
+
+
+def _psql(*statements: str, database: str = "postgres", user: str = None) -> str:
+    """Run SQL statements in the db container, each in its own transaction"""
+    user = user or _db_settings()[0]
+    psql = ["psql", "-U", user, "-d", database, "-v", "ON_ERROR_STOP=1", "-At"]
+    for statement in statements:
+        psql += ["-c", statement]
+    engine = _engine()
+    container = _service_container(engine, DB_SERVICE)
+    if container is not None:
+        output = {1: [], 2: []}
+        status = engine.exec(
+            container, psql, lambda stream, data: output[stream].append(data)
+        )
+        if status:
+            error = b"".join(output[2]).decode().strip()
+            raise RuntimeError(f"Failed to run SQL in the database: {error}")
+        return b"".join(output[1]).decode()
+    cmd = ["exec", "-T", DB_SERVICE, *psql]
+    try:
+        return subprocess.run(
+            [*compose_command(), *cmd], check=True, capture_output=True, text=True
+        ).stdout
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"Failed to run SQL in the database: {e.stderr.strip()}")
+
+
+def _snapshot_database(name: str) -> str:
+    if not name.replace("_", "").isalnum():
+        raise RuntimeError(
+            f"Invalid snapshot name {name}. Use letters, digits and underscores."
+        )
+    return f"{SNAPSHOT_PREFIX}{name}"
+
+
+def _maintenance_database(database: str) -> str:
+    """The database to connect to while copying or dropping another"""
+    # A database can be neither copied nor dropped while we are connected to it
+    return "template1" if database == "postgres" else "postgres"
+
+
+def _disconnect(database: str) -> str:
+    """A statement disconnecting everyone else from a database"""
+    return (
+        "SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+        f"WHERE datname = '{database}' AND pid <> pg_backend_pid()"
+    )
+
+
+def _copy_database(source: str, target: str, user: str, maintenance: str) -> None:
+    # A database can only be used as a template while nothing is connected to
+    # it, so disconnect the app server (which reconnects on its next query)
+    create = f'CREATE DATABASE "{target}" TEMPLATE "{source}"'
+    _psql(_disconnect(source), create, database=maintenance, user=user)
+
+
+def _server_version(database: str, user: str) -> int:
+    """The version of the postgres server, such as 130004 for 13.4"""
+    return int(_psql("SHOW server_version_num", database=database, user=user))
+
+
+def _drop_database(database: str, user: str, maintenance: str) -> None:
+    """Drop a database, disconnecting anything connected to it"""
+    drop = f'DROP DATABASE IF EXISTS "{database}"'
+    if _server_version(maintenance, user) >= 130000:
+        _psql(f"{drop} WITH (FORCE)", database=maintenance, user=user)
+    else:
+        # Before PostgreSQL 13, the app server can reconnect between these
+        _psql(_disconnect(database), drop, database=maintenance, user=user)
+
+
+def snapshot_database(name: str) -> float:
+    """Save a snapshot of the app database within the db container
+
+    The snapshot is a copy of the database made with CREATE DATABASE ...
+    TEMPLATE, which copies its files directly rather than replaying a dump.
+
+    Parameters
+    ----------
+    name
+        The name of the snapshot, made of letters, digits and underscores
+
+    Returns
+    -------
+    float
+        The number of seconds taken
+
+    Raises
+    ------
+    RuntimeError
+        If the snapshot cannot be made
+    """
+    started = time.monotonic()
+    snapshot = _snapshot_database(name)
+    user, database = _db_settings()
+    maintenance = _maintenance_database(database)
+    _psql(f'DROP DATABASE IF EXISTS "{snapshot}"', database=maintenance, user=user)
+    _copy_database(database, snapshot, user, maintenance)
+    return time.monotonic() - started
+
+
+def restore_database(name: str) -> float:
+    """Restore the app database from a snapshot
+
+    This can be called between test modules to give each a known dataset. Any
+    connections to the app database are closed. On PostgreSQL 13 or later this
+    is atomic with dropping it; on earlier versions, a client reconnecting in
+    between makes the restore fail.
+
+    Parameters
+    ----------
+    name
+        The name of the snapshot
+
+    Returns
+    -------
+    float
+        The number of seconds taken
+
+    Raises
+    ------
+    RuntimeError
+        If there is no such snapshot or it cannot be restored
+    """
+    started = time.monotonic()
+    snapshot = _snapshot_database(name)
+    user, database = _db_settings()
+    if name not in list_snapshots(user):
+        raise RuntimeError(f"There is no snapshot named {name}")
+    maintenance = _maintenance_database(database)
+    _drop_database(database, user, maintenance)
+    _copy_database(snapshot, database, user, maintenance)
+    return time.monotonic() - started
+
+
+def list_snapshots(user: str = None) -> List[str]:
+    """The names of the snapshots of the app database
+
+    Raises
+    ------
+    RuntimeError
+        If the database cannot be queried
+    """
+    query = (
+        "SELECT datname FROM pg_database "
+        f"WHERE starts_with(datname, '{SNAPSHOT_PREFIX}') ORDER BY datname"
+    )
+    return [
+        line[len(SNAPSHOT_PREFIX) :]
+        for line in _psql(query, user=user).splitlines()
+        if line
+    ]
+
+
+def delete_snapshot(name: str) -> None:
+    """Delete a snapshot of the app database
+
+    Raises
+    ------
+    RuntimeError
+        If the snapshot cannot be deleted
+    """
+    _psql(f'DROP DATABASE IF EXISTS "{_snapshot_database(name)}"')
+
+
+def _storage_table(table: str, user: str, database: str) -> Tuple[int, Dict]:
+    """The app server's id for a data table and its column ids by name"""
+    query = (
+        "SELECT t.id, t.columns FROM app_storage_tables t "
+        "JOIN app_storage_access a ON a.table_id = t.id "
+        f"WHERE a.python_name = '{table}' LIMIT 1"
+    )
+    result = _psql(query, database=database, user=user).strip()
+    if not result:
+        raise RuntimeError(
+            f"Table {table} is not in the database. Start the app server first."
+        )
+    table_id, columns = result.split("|", 1)
+    return int(table_id), {c["name"]: id for id, c in json.loads(columns).items()}
+
+
+def _parse_bool(value: str) -> bool:
+    normalised = value.strip().lower()
+    if normalised in ("true", "t", "yes", "y", "1"):
+        return True
+    if normalised in ("false", "f", "no", "n", "0"):
+        return False
+    raise ValueError(f"{value!r} is not a boolean")
+
+
+def _parse_number(value: str):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def _column_converter(data_type: str) -> Callable:
+    """A function converting a value read from a file to the column's type"""
+    from datetime import date, datetime
+
+    def text_or(convert):
+        return lambda value: convert(value) if isinstance(value, str) else value
+
+    converters = {
+        "string": str,
+        "number": text_or(_parse_number),
+        "bool": text_or(_parse_bool),
+        "date": lambda value: date.fromisoformat(value).isoformat(),
+        "datetime": lambda value: datetime.fromisoformat(value).isoformat(),
+        "simpleObject": text_or(json.loads),
+    }
+
+    def unsupported(value):
+        raise RuntimeError(f"Loading {data_type} columns is not supported")
+
+    return converters.get(data_type, unsupported)
+
+
+def _read_rows(path: Path):
+    """The rows of a csv or jsonl file as dicts, read one at a time"""
+    import csv
+
+    with Path(path).open(newline="") as f:
+        if Path(path).suffix.lower() == ".csv":
+            for row in csv.DictReader(f):
+                yield {name: value for name, value in row.items() if value != ""}
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def load_table(
+    app: str, table: str, path: Path, progress: Callable = None
+) -> Tuple[int, float]:
+    """Load the rows of a csv or jsonl file into a data table
+
+    The file is streamed into the local database through a single COPY, so
+    memory use does not depend on the size of the file. Values are converted
+    according to the column types in the app's anvil.yaml and empty values are
+    left unset.
+
+    Parameters
+    ----------
+    app
+        The name of the app
+    table
+        The name of the data table
+    path
+        A .csv file with a header row or a .jsonl file with one object per line
+    progress
+        Called with the number of rows sent so far after each chunk of rows
+
+    Returns
+    -------
+    Tuple[int, float]
+        The number of rows loaded and the number of seconds taken
+
+    Raises
+    ------
+    RuntimeError
+        If a column or value does not match the table or the load fails
+    """
+    started = time.monotonic()
+    try:
+        columns = _get_app_config(app)["db_schema"][table]["columns"]
+    except KeyError:
+        raise RuntimeError(f"{app} has no data table {table}")
+    converters = {c["name"]: _column_converter(c["type"]) for c in columns}
+    user, database = _db_settings()
+    table_id, column_ids = _storage_table(table, user, database)
+
+    copy = "COPY app_storage_data (table_id, data) FROM STDIN"
+    cmd = [*compose_command(), "exec", "-T", DB_SERVICE, "psql", "-U", user]
+    cmd += ["-d", database, "-v", "ON_ERROR_STOP=1", "-c", copy]
+    process = subprocess.Popen(
+        cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+    rows = 0
+    chunk = []
+    try:
+        for row in _read_rows(path):
+            try:
+                data = {
+                    column_ids[name]: converters[name](value)
+                    for name, value in row.items()
+                    if value is not None
+                }
+            except KeyError as e:
+                raise RuntimeError(f"{table} has no column {e}")
+            except (TypeError, ValueError) as e:
+                raise RuntimeError(f"Invalid value in row {rows + 1}: {e}")
+            # Backslashes are the only character in JSON output which the COPY
+            # text format needs escaped
+            text = json.dumps(data).replace("\\", "\\\\")
+            chunk.append(f"{table_id}\t{text}\n")
+            rows += 1
+            if len(chunk) == LOAD_CHUNK_ROWS:
+                process.stdin.write("".join(chunk).encode())
+                chunk.clear()
+                if progress:
+                    progress(rows)
+        process.stdin.write("".join(chunk).encode())
+        process.stdin.close()
+    except BrokenPipeError:
+        # psql stopped reading, so report its error below
+        pass
+    except BaseException:
+        # Ending the input would commit the rows sent so far, so end any partial
+        # line and send an empty one, which the server rejects, to roll back
+        try:
+            process.stdin.write(b"\n\n")
+            process.stdin.close()
+        except OSError:
+            pass
+        process.wait()
+        raise
+    error = process.stderr.read().decode()
+    if process.wait() != 0:
+        raise RuntimeError(f"Failed to load {path} into {table}: {error}")
+    return rows, time.monotonic() - started
+
+
+def _get_indexes() -> Dict:
+    try:
+        return _load_yaml(DB_INDEX_FILE) or {}
+    except FileNotFoundError:
+        return {}
+
+
+def _index_name(app: str, table: str, column: str) -> str:
+    import hashlib
+
+    # Postgres truncates names to 63 characters, so a hash keeps long ones unique
+    digest = hashlib.sha1(f"{app}/{table}/{column}".encode()).hexdigest()[:8]
+    return f"amoni_{table}_{column}"[:50] + f"_{digest}"
+
+
+def _index_statement(app: str, table: str, column: str, user: str, database: str):
+    """The CREATE INDEX statement for a column of a data table"""
+    try:
+        columns = _get_app_config(app)["db_schema"][table]["columns"]
+        data_type = next(c["type"] for c in columns if c["name"] == column)
+    except (KeyError, StopIteration):
+        raise RuntimeError(f"{app} has no data table {table} with column {column}")
+    try:
+        method = INDEX_METHODS[data_type]
+    except KeyError:
+        raise RuntimeError(f"{data_type} columns cannot be indexed")
+    table_id, column_ids = _storage_table(table, user, database)
+    name = _index_name(app, table, column)
+    return (
+        f'CREATE INDEX IF NOT EXISTS "{name}" ON app_storage_data '
+        f"USING {method} ((data->'{column_ids[column]}')) "
+        f"WHERE table_id = {table_id}"
+    )
+
+
+def create_index(app: str, table: str, column: str, record: bool = True) -> str:
+    """Index a column of a data table in the local database
+
+    Rows are stored generically as JSON, so the index is on the column's value
+    within each row of the table. Columns of scalar and single link types get a
+    btree index for equality and range searches. simpleObject and multiple link
+    columns get a GIN index for containment searches.
+
+    Parameters
+    ----------
+    app
+        The name of the app
+    table
+        The name of the data table
+    column
+        The name of the column
+    record
+        Whether to record the index in the project so that it is re-created by
+        :func:`apply_indexes`
+
+    Returns
+    -------
+    str
+        The name of the index
+
+    Raises
+    ------
+    RuntimeError
+        If the column cannot be indexed or the app server has not yet created
+        the table
+    """
+    user, database = _db_settings()
+    statement = _index_statement(app, table, column, user, database)
+    _psql(statement, "ANALYZE app_storage_data", database=database, user=user)
+    if record:
+        with Project() as project:
+            project.add_index(app, table, column)
+    return _index_name(app, table, column)
+
+
+def drop_index(app: str, table: str, column: str) -> None:
+    """Drop the index on a column of a data table and remove it from the project
+
+    Raises
+    ------
+    RuntimeError
+        If the index cannot be dropped
+    """
+    user, database = _db_settings()
+    name = _index_name(app, table, column)
+    _psql(f'DROP INDEX IF EXISTS "{name}"', database=database, user=user)
+    with Project() as project:
+        project.remove_index(app, table, column)
+
+
+def list_indexes() -> List[Tuple[str, str, str, bool]]:
+    """The indexes recorded in the project
+
+    Returns
+    -------
+    List[Tuple[str, str, str, bool]]
+        The app, table and column of each index and whether it exists in the
+        local database
+    """
+    indexes = [
+        (app, table, column)
+        for app, tables in _get_indexes().items()
+        for table, columns in tables.items()
+        for column in columns
+    ]
+    if not indexes:
+        return []
+    user, database = _db_settings()
+    query = "SELECT indexname FROM pg_indexes WHERE indexname LIKE 'amoni\\_%'"
+    existing = set(_psql(query, database=database, user=user).splitlines())
+    return [(*index, _index_name(*index) in existing) for index in indexes]
+
+
+def apply_indexes(on_error: Callable = None) -> List[str]:
+    """Create any of the project's recorded indexes missing from the database
+
+    Parameters
+    ----------
+    on_error
+        Called with the name of each index which cannot be created and the
+        error, such as its table not yet being in the database, rather than
+        raising it. The remaining indexes are still created.
+
+    Returns
+    -------
+    List[str]
+        The names of the indexes created
+
+    Raises
+    ------
+    RuntimeError
+        If an index cannot be created and on_error is not given
+    """
+    created = []
+    for app, table, column, exists in list_indexes():
+        if exists:
+            continue
+        try:
+            created.append(create_index(app, table, column, record=False))
+        except RuntimeError as e:
+            if on_error is None:
+                raise
+            on_error(_index_name(app, table, column), e)
+    return created
+
+
+def _set_query_stats(settings: Dict[str, str], message: str) -> None:
+    with Project(message) as project:
+        project.set_postgres_settings(settings)
+    # Recreate the db container so that postgres starts with the new settings
+    _compose("up", "-d", DB_SERVICE, error="Failed to restart the db service")
+    wait_for_services(services=(DB_SERVICE,))
+
+
+def enable_query_stats(explain_after: float = None) -> None:
+    """Record statistics on the queries run in the local database
+
+    Enables pg_stat_statements in the db service, which is restarted, and records
+    the change in the project's docker compose override file.
+
+    Parameters
+    ----------
+    explain_after
+        If given, the plans of queries taking longer than this many milliseconds
+        are written to the db service's log by auto_explain
+
+    Raises
+    ------
+    RuntimeError
+        If the db service cannot be restarted
+    """
+    libraries = "pg_stat_statements"
+    if explain_after is not None:
+        libraries += ",auto_explain"
+        explain_after = f"{explain_after:g}ms"
+    settings = {
+        "shared_preload_libraries": libraries,
+        "pg_stat_statements.track": "all",
+        "auto_explain.log_min_duration": explain_after,
+    }
+    _set_query_stats(settings, "Enable query statistics in the db service")
+    user, database = _db_settings()
+    statement = "CREATE EXTENSION IF NOT EXISTS pg_stat_statements"
+    _psql(statement, database=database, user=user)
+
+
+def disable_query_stats() -> None:
+    """Stop recording statistics on the queries run in the local database
+
+    Raises
+    ------
+    RuntimeError
+        If the db service cannot be restarted
+    """
+    settings = dict.fromkeys(QUERY_STATS_SETTINGS)
+    _set_query_stats(settings, "Disable query statistics in the db service")
+
+
+def _query_stats_psql(statement: str, database: str, user: str) -> str:
+    try:
+        return _psql(statement, database=database, user=user)
+    except RuntimeError as e:
+        if "pg_stat_statements" in str(e):
+            raise RuntimeError(
+                "Query statistics are not enabled. Run 'amoni db profile' first."
+            )
+        raise
+
+
+def _query_tables(user: str, database: str) -> Tuple[Dict, Dict]:
+    """The data table names by their ids and by the ids of their columns"""
+    query = (
+        "SELECT t.id, a.python_name, t.columns FROM app_storage_tables t "
+        "JOIN app_storage_access a ON a.table_id = t.id"
+    )
+    try:
+        result = _psql(query, database=database, user=user)
+    except RuntimeError:
+        # The app server has not yet created its tables
+        return {}, {}
+    by_id, by_column = {}, {}
+    for line in result.splitlines():
+        table_id, name, columns = line.split("|", 2)
+        by_id[table_id] = name
+        by_column.update(dict.fromkeys(json.loads(columns or "{}"), name))
+    return by_id, by_column
+
+
+def query_stats(limit: int = 10, order: str = "time") -> List[Dict]:
+    """The queries run in the local database which took the most time
+
+    Parameters
+    ----------
+    limit
+        The number of queries to return
+    order
+        One of "time", "mean" or "calls" to sort by the total time, the mean time
+        or the number of calls
+
+    Returns
+    -------
+    List[Dict]
+        The calls, total_ms, mean_ms, rows and query text of each query, with the
+        names of the data tables it refers to, where they can be identified
+
+    Raises
+    ------
+    RuntimeError
+        If query statistics are not enabled
+    """
+    import re
+
+    try:
+        order_by = QUERY_STATS_ORDER[order]
+    except KeyError:
+        raise RuntimeError(f"Cannot order queries by {order}")
+    user, database = _db_settings()
+    # PostgreSQL 13 renamed the columns when it added planning times
+    if _server_version(database, user) >= 130000:
+        total, mean = "total_exec_time", "mean_exec_time"
+    else:
+        total, mean = "total_time", "mean_time"
+    statement = (
+        f"SELECT calls, {total} AS total_ms, {mean} AS mean_ms, rows, "
+        "regexp_replace(query, '\\s+', ' ', 'g') FROM pg_stat_statements "
+        "WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())"
+        f" ORDER BY {order_by} DESC LIMIT {int(limit)}"
+    )
+    result = _query_stats_psql(statement, database, user)
+    by_id, by_column = _query_tables(user, database)
+    stats = []
+    for line in result.splitlines():
+        calls, total_ms, mean_ms, rows, query = line.split("|", 4)
+        # Queries only refer to data tables by id, and constants are replaced by
+        # parameters, so tables are found from any ids which remain
+        table_ids = re.findall(r"table_id\s*=\s*(\d+)", query)
+        column_ids = re.findall(r"'([^']+)'", query)
+        tables = {by_id[id] for id in table_ids if id in by_id}
+        tables.update(by_column[id] for id in column_ids if id in by_column)
+        stats.append(
+            {
+                "calls": int(calls),
+                "total_ms": float(total_ms),
+                "mean_ms": float(mean_ms),
+                "rows": int(rows),
+                "query": query,
+                "tables": sorted(tables),
+            }
+        )
+    return stats
+
+
+def reset_query_stats() -> None:
+    """Discard the statistics recorded on queries run in the local database
+
+    Raises
+    ------
+    RuntimeError
+        If query statistics are not enabled
+    """
+    user, database = _db_settings()
+    _query_stats_psql("SELECT pg_stat_statements_reset()", database, user)
+
+
+def postgres_config(profile: str, cpus: int = None, memory: int = None) -> Dict:
+    """The postgres settings for a tuning profile of the db service
+
+    Parameters
+    ----------
+    profile
+        "stock" for postgres' defaults, "tuned" to size memory and parallelism to
+        the resources available to containers, or "fast", which is "tuned" with
+        crash safety turned off and must only be used for disposable data
+    cpus
+        The number of CPUs to tune for. Defaults to those available to docker.
+    memory
+        The bytes of memory to tune for. Defaults to that available to docker.
+
+    Returns
+    -------
+    Dict
+        The settings, with values as they appear in postgresql.conf
+
+    Raises
+    ------
+    RuntimeError
+        If the profile is unknown
+    """
+    if profile not in DB_PROFILES:
+        profiles = ", ".join(DB_PROFILES)
+        raise RuntimeError(f"Unknown profile {profile}. Use one of {profiles}")
+    settings = {"listen_addresses": "'*'"}
+    if profile == "stock":
+        return settings
+    if cpus is None or memory is None:
+        cpus, memory = _docker_resources()
+    megabytes = memory // 2**20
+    # The app server shares the machine, so postgres takes less than it would on
+    # a dedicated host
+    shared_buffers = min(max(megabytes // 8, 128), 4096)
+    per_gather = min(max(cpus // 2, 1), 4)
+    work_mem = (megabytes - shared_buffers) // (DB_MAX_CONNECTIONS * 3) // per_gather
+    settings.update(
+        {
+            "max_connections": str(DB_MAX_CONNECTIONS),
+            "shared_buffers": f"{shared_buffers}MB",
+            "effective_cache_size": f"{megabytes // 2}MB",
+            "work_mem": f"{min(max(work_mem, 4), 256)}MB",
+            "maintenance_work_mem": f"{min(max(megabytes // 16, 64), 2048)}MB",
+            "max_wal_size": "4GB",
+            "min_wal_size": "1GB",
+            "checkpoint_completion_target": "0.9",
+            "random_page_cost": "1.1",
+            "effective_io_concurrency": "200",
+            "max_worker_processes": str(max(cpus, 8)),
+            "max_parallel_workers": str(cpus),
+            "max_parallel_workers_per_gather": str(per_gather),
+        }
+    )
+    if profile == "fast":
+        settings.update(
+            {"fsync": "off", "synchronous_commit": "off", "full_page_writes": "off"}
+        )
+    return settings
+
+
+def write_db_config() -> List[Path]:
+    """Write the configuration file of each tuning profile for this machine
+
+    Returns
+    -------
+    List[Path]
+        The files which changed
+    """
+    cpus, memory = _docker_resources()
+    written = []
+    for profile in DB_PROFILES:
+        settings = postgres_config(profile, cpus, memory)
+        content = "".join(f"{key} = {value}\n" for key, value in settings.items())
+        target = DB_CONFIG_DIR / f"postgresql.{profile}.conf"
+        DB_CONFIG_DIR.mkdir(exist_ok=True)
+        if _write_if_changed(target, f"{DB_CONFIG_HEADER}\n{content}"):
+            written.append(target)
+    return written
+
+
+def _db_config_mounted() -> bool:
+    try:
+        override = _load_yaml(_compose_override_file()) or {}
+    except FileNotFoundError:
+        return False
+    service = override.get("services", {}).get(DB_SERVICE, {})
+    return DB_CONFIG_VOLUME in service.get("volumes", [])
+
+
+def refresh_db_config() -> bool:
+    """Rewrite the db service's configuration files if the project uses them
+
+    The files depend on the machine, so they are not committed and are written
+    again before the services start.
+
+    Returns
+    -------
+    bool
+        Whether the project uses amoni's configuration files
+    """
+    if not _db_config_mounted():
+        return False
+    write_db_config()
+    return True
+
+
+def tune_database(profile: str = "tuned") -> Dict:
+    """Run the db service with settings sized to this machine
+
+    Writes a configuration file for each tuning profile, mounts the one selected
+    by AMONI_DB_PROFILE in .env into the db service and restarts it.
+
+    Parameters
+    ----------
+    profile
+        The profile to select. See :func:`postgres_config`.
+
+    Returns
+    -------
+    Dict
+        The settings of the selected profile
+
+    Raises
+    ------
+    RuntimeError
+        If the profile is unknown or the db service cannot be restarted
+    """
+    from dotenv import set_key
+
+    settings = postgres_config(profile)
+    write_db_config()
+    ignore = DB_CONFIG_DIR / ".gitignore"
+    _write_if_changed(ignore, "postgresql.*.conf\n")
+    env_path = Path(".env")
+    env_path.touch()
+    set_key(env_path, "AMONI_DB_PROFILE", profile, quote_mode="never")
+    with Project(f"Use the {profile} profile for the db service") as project:
+        project.mount_db_config()
+        project.stage(ignore, env_path)
+    # A value already in the environment would take precedence over .env
+    env = {**os.environ, "AMONI_DB_PROFILE": profile}
+    _compose("up", "-d", DB_SERVICE, error="Failed to restart the db service", env=env)
+    wait_for_services(services=(DB_SERVICE,))
+    return settings
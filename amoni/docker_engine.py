@@ -0,0 +1,246 @@
+# SPDX-License-Identifier: MIT
+#
+# Copyright (c) 2021 The Amoni project team members listed at
+# https://github.com/anvilistas/amoni/graphs/contributors
+#
+# This software is published at https://github.com/anvilistas/amoni
+"""A minimal client for the Docker Engine API
+
+It speaks HTTP to the docker daemon over its unix socket, or a tcp address given
+by DOCKER_HOST, so that status queries, exec and logs take milliseconds rather
+than the time needed to start a docker CLI process.
+"""
+
+import http.client
+import json
+import os
+import socket
+import struct
+from typing import Callable, Dict, Iterator, List, Tuple
+from urllib.parse import quote, urlencode, urlsplit
+
+__version__ = "0.0.13"
+
+DEFAULT_HOST = "unix:///var/run/docker.sock"
+TIMEOUT = float(os.environ.get("AMONI_DOCKER_TIMEOUT", "10"))
+STDOUT, STDERR = 1, 2
+
+
+class _UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: float = None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def _frames(response, tty: bool) -> Iterator[Tuple[int, bytes]]:
+    """The (stream, data) chunks of an attached stream
+
+    Without a tty, docker multiplexes stdout and stderr by prefixing each chunk
+    with its stream and length.
+    """
+    if tty:
+        while True:
+            data = response.read1(65536)
+            if not data:
+                return
+            yield STDOUT, data
+    while True:
+        header = response.read(8)
+        if len(header) < 8:
+            return
+        stream, size = struct.unpack(">BxxxL", header)
+        yield stream, response.read(size)
+
+
+class DockerEngine:
+    """A connection to the docker daemon
+
+    Parameters
+    ----------
+    host
+        The address of the daemon, such as unix:///var/run/docker.sock or
+        tcp://localhost:2375. Defaults to DOCKER_HOST or the standard socket.
+    timeout
+        The seconds to wait for a response, other than for followed logs
+
+    Examples
+    --------
+    >>> engine = DockerEngine()
+    >>> if engine.ping():
+    ...     containers = engine.containers({"com.docker.compose.service": "db"})
+    """
+
+    def __init__(self, host: str = None, timeout: float = TIMEOUT):
+        self.host = host or os.environ.get("DOCKER_HOST") or DEFAULT_HOST
+        self.timeout = timeout
+
+    def _connection(self, timeout: float) -> http.client.HTTPConnection:
+        url = urlsplit(self.host)
+        if url.scheme == "unix":
+            return _UnixConnection(url.path, timeout=timeout)
+        if url.scheme == "tcp":
+            return http.client.HTTPConnection(
+                url.hostname, url.port or 2375, timeout=timeout
+            )
+        raise RuntimeError(f"Unsupported docker host {self.host}")
+
+    def _request(
+        self, method: str, path: str, body: Dict = None, stream: bool = False
+    ) -> http.client.HTTPResponse:
+        """Send a request, returning the response if it succeeded
+
+        A streamed response is left unread and has no timeout.
+        """
+        connection = self._connection(None if stream else self.timeout)
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        payload = json.dumps(body) if body is not None else None
+        try:
+            connection.request(method, path, body=payload, headers=headers)
+            response = connection.getresponse()
+        except OSError as e:
+            connection.close()
+            raise RuntimeError(f"Cannot reach the docker daemon at {self.host}: {e}")
+        if response.status >= 400:
+            content = response.read()
+            connection.close()
+            try:
+                message = json.loads(content)["message"]
+            except (ValueError, KeyError, TypeError):
+                message = content.decode(errors="replace")
+            raise RuntimeError(f"Docker request {method} {path} failed: {message}")
+        return response
+
+    def _json(self, method: str, path: str, body: Dict = None):
+        response = self._request(method, path, body)
+        content = response.read()
+        response.close()
+        return json.loads(content) if content else None
+
+    def ping(self) -> bool:
+        """Whether the daemon can be reached"""
+        try:
+            response = self._request("GET", "/_ping")
+            return response.read() == b"OK"
+        except RuntimeError:
+            return False
+
+    def containers(self, labels: Dict[str, str] = None, all: bool = False) -> List:
+        """The containers with the given labels
+
+        Parameters
+        ----------
+        labels
+            The label values the containers must have
+        all
+            Whether to include containers which are not running
+        """
+        query = {"all": "1" if all else "0"}
+        if labels:
+            filters = {"label": [f"{key}={value}" for key, value in labels.items()]}
+            query["filters"] = json.dumps(filters)
+        return self._json("GET", f"/containers/json?{urlencode(query)}")
+
+    def inspect(self, container: str) -> Dict:
+        """The details of a container, or None if there is no such container"""
+        try:
+            return self._json("GET", f"/containers/{quote(container)}/json")
+        except RuntimeError as e:
+            if "No such container" in str(e):
+                return None
+            raise
+
+    def image(self, name: str) -> Dict:
+        """The details of a local image, or None if there is no such image"""
+        try:
+            return self._json("GET", f"/images/{quote(name, safe='/:@')}/json")
+        except RuntimeError as e:
+            if "No such image" in str(e):
+                return None
+            raise
+
+    def distribution(self, name: str) -> Dict:
+        """The descriptor of an image in its registry, without pulling it"""
+        return self._json("GET", f"/distribution/{quote(name, safe='/:@')}/json")
+
+    def start(self, container: str) -> None:
+        """Start a stopped container"""
+        self._json("POST", f"/containers/{quote(container)}/start")
+
+    def remove(self, container: str) -> None:
+        """Stop and remove a container, if it exists"""
+        try:
+            self._json("DELETE", f"/containers/{quote(container)}?force=1")
+        except RuntimeError as e:
+            if "No such container" not in str(e):
+                raise
+
+    def exec(
+        self,
+        container: str,
+        command: List[str],
+        output: Callable[[int, bytes], None] = None,
+        tty: bool = False,
+    ) -> int:
+        """Run a command in a running container
+
+        Parameters
+        ----------
+        container
+            The id or name of the container
+        command
+            The command and its arguments
+        output
+            Called with the stream, STDOUT or STDERR, and data of each chunk of
+            output as it arrives
+        tty
+            Whether to run the command in a terminal, which combines its output
+            into STDOUT
+
+        Returns
+        -------
+        int
+            The exit status of the command
+        """
+        body = {"AttachStdout": True, "AttachStderr": True, "Tty": tty, "Cmd": command}
+        created = self._json("POST", f"/containers/{quote(container)}/exec", body)
+        start = {"Detach": False, "Tty": tty}
+        response = self._request("POST", f"/exec/{created['Id']}/start", start, True)
+        try:
+            for stream, data in _frames(response, tty):
+                if output:
+                    output(stream, data)
+        finally:
+            response.close()
+        return self._json("GET", f"/exec/{created['Id']}/json")["ExitCode"]
+
+    def logs(
+        self, container: str, follow: bool = False, tail: str = "all"
+    ) -> Iterator[Tuple[int, bytes]]:
+        """The (stream, data) chunks of a container's logs
+
+        Parameters
+        ----------
+        container
+            The id or name of the container
+        follow
+            Whether to keep waiting for further output
+        tail
+            The number of lines from the end of the logs to start with, or "all"
+        """
+        details = self.inspect(container)
+        if details is None:
+            raise RuntimeError(f"There is no container {container}")
+        query = urlencode(
+            {"stdout": 1, "stderr": 1, "follow": int(follow), "tail": tail}
+        )
+        path = f"/containers/{quote(container)}/logs?{query}"
+        response = self._request("GET", path, stream=True)
+        try:
+            yield from _frames(response, details["Config"].get("Tty", False))
+        finally:
+            response.close()
@@ -0,0 +1,316 @@
+# SPDX-License-Identifier: MIT
+#
+# Copyright (c) 2021 The Amoni project team members listed at
+# https://github.com/anvilistas/amoni/graphs/contributors
+#
+# This software is published at https://github.com/anvilistas/amoni
+"""Selecting the tests affected by changes since the tests last passed
+
+Test files are chosen by following the imports between the project's python files,
+and are named as the test runner container sees them.
+"""
+
+import json
+import os
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+from .api import (
+    TABLE_STUB_DIR,
+    TEST_SERVICE,
+    _compose_config,
+    _git,
+    _is_test_file,
+    _project_cache_dir,
+    _write_atomic,
+)
+
+__version__ = "0.0.13"
+
+# The working directory of the test runner image, where pytest runs
+TEST_WORKDIR = "/code"
+# Changes to files like these outside the apps cannot affect the tests
+DOCUMENT_SUFFIXES = (".md", ".rst")
+
+
+def _python_files() -> List[Path]:
+    """The python files in the project, relative to its root"""
+    skip = {"__pycache__", TABLE_STUB_DIR.parts[0]}
+    files = []
+    for root, dirs, names in os.walk("."):
+        dirs[:] = [d for d in dirs if not d.startswith(".") and d not in skip]
+        files.extend(Path(root, n) for n in names if n.endswith(".py"))
+    return [Path(os.path.normpath(f)) for f in files]
+
+
+def _module_parts(path: Path) -> Tuple[str, ...]:
+    parts = path.with_suffix("").parts
+    return parts[:-1] if parts[-1] == "__init__" else parts
+
+
+def _imported_names(path: Path) -> List[str]:
+    """The fully qualified names of the modules a python file imports"""
+    import ast
+
+    try:
+        tree = ast.parse(path.read_bytes(), filename=str(path))
+    except (SyntaxError, ValueError):
+        return []
+    package = path.parent.parts
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            base = package[: len(package) - node.level + 1] if node.level else ()
+            module = (*base, *(node.module.split(".") if node.module else ()))
+            names.add(".".join(module))
+            names.update(".".join((*module, alias.name)) for alias in node.names)
+    # Importing a.b.c also imports a and a.b
+    prefixes = set()
+    for name in names:
+        parts = name.split(".")
+        prefixes.update(".".join(parts[:i]) for i in range(1, len(parts) + 1))
+    prefixes.discard("")
+    return sorted(prefixes)
+
+
+def _import_graph() -> Dict[str, List[str]]:
+    """The files each python file in the project imports
+
+    The names each file imports are cached per project and a file is only
+    parsed again when its modification time changes.
+    """
+    cache_file = _project_cache_dir() / "imports.json"
+    try:
+        cache = json.loads(cache_file.read_text())
+    except (OSError, ValueError):
+        cache = {}
+
+    files = _python_files()
+    imports = {}
+    for path in files:
+        key = path.as_posix()
+        mtime = path.stat().st_mtime
+        if key not in cache or cache[key][0] != mtime:
+            cache[key] = [mtime, _imported_names(path)]
+        imports[key] = cache[key][1]
+    cache = {key: cache[key] for key in imports}
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    cache_file.write_text(json.dumps(cache))
+
+    # A file can be imported by any trailing part of its dotted path, depending
+    # on what is on sys.path, so map each of those names to the file
+    modules = {}
+    for path in files:
+        parts = _module_parts(path)
+        for i in range(len(parts)):
+            modules.setdefault(".".join(parts[i:]), []).append(path.as_posix())
+    return {
+        key: sorted({f for name in names for f in modules.get(name, ()) if f != key})
+        for key, names in imports.items()
+    }
+
+
+def select_tests(changed: Iterable[str]) -> List[str]:
+    """Select the test files affected by changes to the given files
+
+    A test file is affected if it changed or if it imports, directly or
+    indirectly, a python file which changed. A changed file within an app which
+    is not python affects the package in its folder. Generated table stubs and
+    documentation files affect no tests.
+
+    Other files, including those at the root of an app such as anvil.yaml, can
+    affect any test, so that all of them are run.
+
+    Parameters
+    ----------
+    changed
+        The changed paths, relative to the project root
+
+    Returns
+    -------
+    List[str]
+        The affected test files as the test runner sees them, like the node ids
+        of :func:`amoni.api.collect_tests`, or None if every test should run because a
+        change could affect them all (a conftest.py, an app's anvil.yaml or
+        project configuration)
+    """
+    graph = _import_graph()
+    dependents = {}
+    for path, imported in graph.items():
+        for target in imported:
+            dependents.setdefault(target, set()).add(path)
+
+    affected = set()
+    for path in map(Path, changed):
+        if path.name == "conftest.py":
+            return None
+        if path.suffix != ".py":
+            if path.parts[:1] == TABLE_STUB_DIR.parts[:1] or (
+                path.parts[:1] != ("app",) and path.suffix in DOCUMENT_SUFFIXES
+            ):
+                continue
+            package = (path.parent / "__init__.py").as_posix()
+            # Files at the root of an app, or of app/, configure the whole app
+            in_package = path.parts[:1] == ("app",) and len(path.parts) > 3
+            if not in_package or package not in graph:
+                return None
+            path = Path(package)
+        affected.add(path.as_posix())
+
+    pending = list(affected)
+    while pending:
+        for dependent in dependents.get(pending.pop(), ()):
+            if dependent not in affected:
+                affected.add(dependent)
+                pending.append(dependent)
+    tests = [p for p in affected if p in graph and _is_test_file(Path(p))]
+    return sorted(filter(None, map(_runner_path, tests)))
+
+
+def _volume_mount(volume) -> Tuple[str, str]:
+    """The source and target of a compose volume, in its short or long form"""
+    if isinstance(volume, dict):
+        return volume.get("source"), volume.get("target")
+    parts = volume.split(":")
+    if len(parts) > 2 and all(len(option) <= 2 for option in parts[-1].split(",")):
+        # A mode such as ro or rw,z
+        parts = parts[:-1]
+    if len(parts) < 2:
+        return None, parts[0]
+    return ":".join(parts[:-1]), parts[-1]
+
+
+@lru_cache(maxsize=None)
+def _runner_mounts() -> Tuple[Tuple[Tuple[Path, str], ...], str]:
+    """The folders bound into the test runner with where they appear in it,
+    deepest first, and the test runner's working directory"""
+    import posixpath
+
+    service = _compose_config()["services"].get(TEST_SERVICE) or {}
+    workdir = service.get("working_dir") or TEST_WORKDIR
+    mounts = []
+    for volume in service.get("volumes") or []:
+        source, target = _volume_mount(volume)
+        # Other sources are named volumes
+        if source and (source[:1] in (".", "~") or Path(source).is_absolute()):
+            target = posixpath.normpath(posixpath.join(workdir, target))
+            mounts.append((Path(source).expanduser().resolve(), target))
+    mounts.sort(key=lambda mount: len(mount[0].parts), reverse=True)
+    return tuple(mounts), workdir
+
+
+def _runner_path(path: str) -> str:
+    """A project path as the test runner sees it, relative to its working
+    directory, or None if it is not mounted in the test runner
+
+    Without any bound folders, the project is taken to be the working directory.
+    """
+    import posixpath
+
+    mounts, workdir = _runner_mounts()
+    if not mounts:
+        return path
+    host = Path(path).resolve()
+    for source, target in mounts:
+        if host == source or source in host.parents:
+            inside = posixpath.join(target, host.relative_to(source).as_posix())
+            inside = posixpath.normpath(inside)
+            if inside.startswith(workdir.rstrip("/") + "/"):
+                return posixpath.relpath(inside, workdir)
+            return inside
+    return None
+
+
+def _submodule_paths() -> List[str]:
+    import pygit2
+
+    return pygit2.Repository(".").listall_submodules()
+
+
+def _last_green_file() -> Path:
+    return _project_cache_dir() / "last_green.json"
+
+
+def _working_tree_commit(path: str) -> str:
+    """A commit of the working tree at the given path, without changing it
+
+    This is HEAD unless there are uncommitted changes, in which case it is a
+    dangling commit of them as made by git stash.
+    """
+    error = f"Failed to read the working tree of {path}"
+    stash = _git("stash", "create", cwd=path, error=error).stdout.strip()
+    return stash or _git("rev-parse", "HEAD", cwd=path, error=error).stdout.strip()
+
+
+def _untracked_files(path: str) -> Dict[str, str]:
+    """The object id of each untracked, unignored file in a repository"""
+    error = f"Failed to list the untracked files in {path}"
+    untracked = ["ls-files", "-z", "--others", "--exclude-standard"]
+    names = [n for n in _git(*untracked, cwd=path, error=error).stdout.split("\0") if n]
+    if not names:
+        return {}
+    hash_object = ["hash-object", "--stdin-paths"]
+    ids = _git(*hash_object, cwd=path, input="\n".join(names), error=error)
+    return dict(zip(names, ids.stdout.split()))
+
+
+def record_green() -> None:
+    """Record the current state of the project as the last in which the tests
+    passed
+
+    Untracked files are recorded by content, as git stash does not include them.
+    """
+    paths = ["."]
+    paths += [p for p in _submodule_paths() if Path(p, ".git").exists()]
+    state = {
+        path: {
+            "commit": _working_tree_commit(path),
+            "untracked": _untracked_files(path),
+        }
+        for path in paths
+    }
+    _last_green_file().parent.mkdir(parents=True, exist_ok=True)
+    _write_atomic(_last_green_file(), json.dumps(state))
+
+
+def changed_since_green() -> List[str]:
+    """The files which have changed since the tests last passed
+
+    Changes within app submodules are included, as are uncommitted changes and
+    untracked files which were added or changed.
+
+    Returns
+    -------
+    List[str]
+        The changed paths relative to the project root, or None if the tests
+        have not passed before
+    """
+    try:
+        state = json.loads(_last_green_file().read_text())
+    except (OSError, ValueError):
+        return None
+
+    submodules = set(_submodule_paths())
+    changed = set()
+    for path, green in state.items():
+        if not isinstance(green, dict):
+            # Recorded before untracked files were, so that all of them count
+            green = {"commit": green, "untracked": {}}
+        diff = ["diff", "--name-only", "--no-renames", green["commit"]]
+        error = f"Failed to find the changes in {path}"
+        try:
+            names = _git(*diff, cwd=path, error=error).stdout.split("\n")
+        except RuntimeError:
+            # The recorded commit is unknown, eg after a force push
+            return None
+        untracked = _untracked_files(path).items()
+        names += [name for name, _ in untracked ^ green["untracked"].items()]
+        changed.update(
+            Path(path, name).as_posix()
+            for name in names
+            if name and (path != "." or name not in submodules)
+        )
+    return sorted(changed)
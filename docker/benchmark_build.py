@@ -0,0 +1,94 @@
+# SPDX-License-Identifier: MIT
+#
+# Copyright (c) 2021 The Amoni project team members listed at
+# https://github.com/anvilistas/amoni/graphs/contributors
+#
+# This software is published at https://github.com/anvilistas/amoni
+"""Time builds of the app server and test runner images
+
+Run from the root of the repository:
+
+    python docker/benchmark_build.py --output build-times.json
+
+Each image is built three times:
+
+cold
+    With an empty build cache
+registry
+    With an empty build cache, reusing the layers of the published image
+warm
+    After a one line change to the image's requirements.txt
+
+Emptying the build cache removes the build cache of every image on this machine.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import time
+from pathlib import Path
+
+__version__ = "0.0.13"
+
+IMAGES = {
+    "app_server": "ghcr.io/anvilistas/amoni/app-server:latest",
+    "test_runner": "ghcr.io/anvilistas/amoni/test_runner:latest",
+}
+BUILD_ENV = {**os.environ, "DOCKER_BUILDKIT": "1"}
+
+
+def _prune() -> None:
+    subprocess.run(["docker", "builder", "prune", "--all", "--force"], check=True)
+
+
+def _build(image: str, cache_from: str = None) -> float:
+    """Build an image, returning the seconds taken"""
+    command = ["docker", "build", "--file", f"docker/{image}/Dockerfile"]
+    if cache_from:
+        command += ["--cache-from", cache_from]
+    command += ["--tag", f"amoni-benchmark/{image}", "."]
+    started = time.monotonic()
+    subprocess.run(command, check=True, env=BUILD_ENV, stdout=subprocess.DEVNULL)
+    return time.monotonic() - started
+
+
+def benchmark(image: str) -> dict:
+    """The seconds taken by cold, registry and warm builds of an image"""
+    _prune()
+    timings = {"cold": _build(image)}
+    _prune()
+    timings["registry"] = _build(image, IMAGES[image])
+    requirements = Path("docker", image, "requirements.txt")
+    original = requirements.read_text()
+    try:
+        requirements.write_text(original + f"# benchmark {time.time()}\n")
+        timings["warm"] = _build(image)
+    finally:
+        requirements.write_text(original)
+    return timings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("images", nargs="*", help=f"Any of {', '.join(IMAGES)}")
+    parser.add_argument("--output", type=Path, help="Where to save the timings")
+    args = parser.parse_args()
+    unknown = set(args.images) - set(IMAGES)
+    if unknown:
+        parser.error(f"Unknown images {', '.join(sorted(unknown))}")
+    results = {}
+    for image in args.images or IMAGES:
+        results[image] = benchmark(image)
+        print(
+            f"{image}: "
+            + ", ".join(
+                f"{kind} {seconds:.1f}s" for kind, seconds in results[image].items()
+            )
+        )
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+#!/bin/sh
+# SPDX-License-Identifier: MIT
+#
+# Copyright (c) 2021 The Amoni project team members listed at
+# https://github.com/anvilistas/amoni/graphs/contributors
+#
+# This software is published at https://github.com/anvilistas/amoni
+#
+# Put the anvil app server runtime in its package folder, using the copy in a
+# cache folder if there is one and adding it to the cache if not.
+#
+# Usage: cache_app_server.sh <folder with python and anvil-app-server> <cache folder>
+set -e
+bin="$1"
+cache="$2"
+package="$("$bin/python" -c 'from importlib.util import find_spec; import os
+print(os.path.dirname(find_spec("anvil_app_server").origin))')"
+jar="$(grep -om1 'anvil-app-server\.[0-9-]*\.jar' "$package/__init__.py")"
+if [ -f "$cache/$jar" ]; then
+    cp "$cache/$jar" "$package/"
+else
+    # Launching downloads the runtime, then fails for want of java
+    "$bin/anvil-app-server" || true
+    mkdir -p "$cache"
+    cp "$package/$jar" "$cache/"
+fi
+# Runtimes of earlier versions are no longer needed
+find "$cache" -name '*.jar' ! -name "$jar" -delete
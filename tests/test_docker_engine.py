@@ -0,0 +1,125 @@
+# SPDX-License-Identifier: MIT
+#
+# Copyright (c) 2021 The Amoni project team members listed at
+# https://github.com/anvilistas/amoni/graphs/contributors
+#
+# This software is published at https://github.com/anvilistas/amoni
+"""The docker engine client against a fake daemon serving canned responses"""
+
+import json
+import socketserver
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+from amoni.docker_engine import STDERR, STDOUT, DockerEngine
+
+CONTAINER = {"Id": "abc123", "State": {"Running": True}, "Config": {"Tty": False}}
+
+
+def _frame(stream: int, data: bytes) -> bytes:
+    return struct.pack(">BxxxL", stream, len(data)) + data
+
+
+# (method, path) -> (status, body)
+RESPONSES = {
+    ("GET", "/_ping"): (200, b"OK"),
+    ("GET", "/containers/json"): (200, json.dumps([CONTAINER]).encode()),
+    ("GET", "/containers/abc123/json"): (200, json.dumps(CONTAINER).encode()),
+    ("GET", "/containers/missing/json"): (
+        404,
+        b'{"message": "No such container: missing"}',
+    ),
+    ("GET", "/containers/broken/json"): (500, b"daemon exploded"),
+    ("POST", "/containers/abc123/exec"): (201, b'{"Id": "e1"}'),
+    ("POST", "/exec/e1/start"): (
+        200,
+        _frame(STDOUT, b"out") + _frame(STDERR, b"err") + _frame(STDOUT, b"put"),
+    ),
+    ("GET", "/exec/e1/json"): (200, b'{"ExitCode": 3}'),
+}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def _respond(self):
+        url = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        self.server.requests.append((self.command, url.path, parse_qs(url.query), body))
+        status, content = RESPONSES.get((self.command, url.path), (404, b"{}"))
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = do_DELETE = _respond
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # BaseHTTPRequestHandler expects a client address it can format
+        request, _ = super().get_request()
+        return request, ("local", 0)
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    server = _Server(str(tmp_path / "docker.sock"), _Handler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def engine(daemon):
+    return DockerEngine(f"unix://{daemon.server_address}", timeout=5)
+
+
+def test_ping(engine, tmp_path):
+    assert engine.ping()
+    assert not DockerEngine(f"unix://{tmp_path}/absent.sock").ping()
+
+
+def test_containers_filters_by_label(engine, daemon):
+    assert engine.containers({"com.docker.compose.service": "db"}) == [CONTAINER]
+    _, _, query, _ = daemon.requests[-1]
+    assert query["all"] == ["0"]
+    filters = json.loads(query["filters"][0])
+    assert filters == {"label": ["com.docker.compose.service=db"]}
+
+
+def test_inspect(engine):
+    assert engine.inspect("abc123") == CONTAINER
+    assert engine.inspect("missing") is None
+
+
+def test_errors_are_runtime_errors(engine):
+    with pytest.raises(RuntimeError, match="failed: daemon exploded"):
+        engine.inspect("broken")
+    with pytest.raises(RuntimeError, match="Unsupported docker host"):
+        DockerEngine("ssh://example.com").containers()
+
+
+def test_unreachable_daemon(tmp_path):
+    engine = DockerEngine(f"unix://{tmp_path}/absent.sock")
+    with pytest.raises(RuntimeError, match="Cannot reach the docker daemon"):
+        engine.containers()
+
+
+def test_exec_demultiplexes_output(engine, daemon):
+    output = []
+    status = engine.exec("abc123", ["ls", "-l"], lambda *chunk: output.append(chunk))
+    assert status == 3
+    assert output == [(STDOUT, b"out"), (STDERR, b"err"), (STDOUT, b"put")]
+    assert daemon.requests[0][3]["Cmd"] == ["ls", "-l"]
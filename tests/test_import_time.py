@@ -0,0 +1,54 @@
+# SPDX-License-Identifier: MIT
+#
+# Copyright (c) 2021 The Amoni project team members listed at
+# https://github.com/anvilistas/amoni/graphs/contributors
+#
+# This software is published at https://github.com/anvilistas/amoni
+"""The CLI must start quickly because shell completion runs it on every keystroke"""
+
+import os
+import subprocess
+import sys
+
+# The time amoni's own modules may take to import, once typer is loaded. They take
+# around 12ms on a typical laptop.
+BUDGET_MS = 30
+HEAVY_MODULES = ("pygit2", "keyring", "cookiecutter", "yaml", "dotenv", "watchdog")
+
+
+def _import_times(tmp_path):
+    """The self and cumulative import time in microseconds of each module"""
+    env = {**os.environ, "PYTHONPYCACHEPREFIX": str(tmp_path)}
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    command = [sys.executable, "-X", "importtime", "-c", "import amoni.cli.amoni"]
+    # Warm the bytecode cache, as for an installed package
+    subprocess.run(command, env=env, check=True, capture_output=True)
+    # Load typer first so that only amoni's own imports are measured
+    command[-1] = "import typer; import amoni.cli.amoni"
+    stderr = subprocess.run(
+        command, env=env, check=True, capture_output=True, text=True
+    ).stderr
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = (int(own), int(cumulative))
+    return times
+
+
+def test_heavy_dependencies_are_not_imported(tmp_path):
+    imported = _import_times(tmp_path)
+    loaded = [
+        module
+        for module in imported
+        if module.split(".")[0] in HEAVY_MODULES or module == "_pygit2"
+    ]
+    assert loaded == []
+
+
+def test_startup_is_within_budget(tmp_path):
+    best = min(
+        _import_times(tmp_path / str(run))["amoni.cli.amoni"][1] for run in range(3)
+    )
+    assert best / 1000 < BUDGET_MS
@@ -0,0 +1,109 @@
+# SPDX-License-Identifier: MIT
+#
+# Copyright (c) 2021 The Amoni project team members listed at
+# https://github.com/anvilistas/amoni/graphs/contributors
+#
+# This software is published at https://github.com/anvilistas/amoni
+"""Choosing the tests affected by changes since they last passed"""
+
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from amoni import selection
+
+FILES = {
+    "app/config.yaml": "app: /app/main\n",
+    "app/main/anvil.yaml": "name: main\n",
+    "app/main/server_code/__init__.py": "",
+    "app/main/server_code/orders.py": "from . import utils\n",
+    "app/main/server_code/utils.py": "",
+    "app/main/server_code/prices.json": "{}\n",
+    "tests/conftest.py": "",
+    "tests/test_orders.py": "from server_code import orders\n",
+    "tests/test_other.py": "import os\n",
+    "README.md": "# Project\n",
+}
+
+
+def _git(*args):
+    subprocess.run(["git", *args], check=True, capture_output=True)
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    root = tmp_path / "project"
+    for name, content in FILES.items():
+        Path(root, name).parent.mkdir(parents=True, exist_ok=True)
+        Path(root, name).write_text(content)
+    monkeypatch.chdir(root)
+    monkeypatch.setenv("AMONI_CACHE_DIR", str(tmp_path / "cache"))
+    for variable in ("GIT_AUTHOR", "GIT_COMMITTER"):
+        monkeypatch.setenv(f"{variable}_NAME", "amoni")
+        monkeypatch.setenv(f"{variable}_EMAIL", "amoni@example.com")
+    # Without a test runner service, paths are the same in the test runner
+    monkeypatch.setattr(selection, "_compose_config", lambda: {"services": {}})
+    selection._runner_mounts.cache_clear()
+    _git("init", "--quiet")
+    _git("add", ".")
+    _git("commit", "--quiet", "--message", "Initial commit")
+    yield root
+    selection._runner_mounts.cache_clear()
+
+
+def test_imported_names(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    Path("a", "b").mkdir(parents=True)
+    Path("a", "b", "m.py").write_text(
+        "import x.y\nfrom . import c\nfrom ..d import e\nimport broken(\n"
+    )
+    assert selection._imported_names(Path("a", "b", "m.py")) == []
+    Path("a", "b", "m.py").write_text(
+        "import x.y\nfrom . import c\nfrom ..d import e\n"
+    )
+    assert selection._imported_names(Path("a", "b", "m.py")) == [
+        "a",
+        "a.b",
+        "a.b.c",
+        "a.d",
+        "a.d.e",
+        "x",
+        "x.y",
+    ]
+
+
+@pytest.mark.parametrize(
+    "changed, selected",
+    [
+        (["app/main/server_code/utils.py"], ["tests/test_orders.py"]),
+        (["app/main/server_code/prices.json"], ["tests/test_orders.py"]),
+        (["tests/test_other.py"], ["tests/test_other.py"]),
+        (["README.md"], []),
+        (["app/main/anvil.yaml"], None),
+        (["app/config.yaml"], None),
+        (["tests/conftest.py"], None),
+        (["pyproject.toml"], None),
+    ],
+)
+def test_select_tests(project, changed, selected):
+    assert selection.select_tests(changed) == selected
+
+
+def test_changed_since_green(project):
+    assert selection.changed_since_green() is None
+    Path("scratch.txt").write_text("kept out of git\n")
+    selection.record_green()
+    assert selection.changed_since_green() == []
+
+    Path("app/main/server_code/utils.py").write_text("TAX = 0.2\n")
+    Path("tests/test_new.py").write_text("")
+    assert selection.changed_since_green() == [
+        "app/main/server_code/utils.py",
+        "tests/test_new.py",
+    ]
+
+    Path("scratch.txt").write_text("edited\n")
+    assert "scratch.txt" in selection.changed_since_green()
+    selection.record_green()
+    assert selection.changed_since_green() == []